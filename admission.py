@@ -0,0 +1,482 @@
+"""
+File: admission.py
+Description: Process-wide admission scheduler for Gemini calls.
+Every generate_content call made through a ScheduledClient first takes one
+request from an RPM token bucket and its estimated tokens from a TPM bucket.
+Callers queue by priority class (interactive > speculative > eval): a lower
+class is only admitted when no higher class is waiting, and may not drain the
+buckets below a reserve kept for live users. Queues are bounded and every
+wait has a deadline, so overload turns into a fast, local rejection instead of
+a burst of 429s. With ADMISSION_DB the buckets (and which classes are waiting)
+live in a SQLite file, so Streamlit workers and eval runs on one machine share
+the key's quota.
+
+Environment: GEMINI_RPM, GEMINI_TPM (either enables the scheduler),
+ADMISSION_DB, ADMISSION_RESERVE, ADMISSION_QUEUE, ADMISSION_DEADLINE_<CLASS>.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+import contextlib
+import contextvars
+from collections import deque, defaultdict
+
+from google.genai import errors
+
+import resilience
+from text_utils import estimate_tokens
+from tracing import tracer
+
+INTERACTIVE = 0
+SPECULATIVE = 1
+EVAL = 2
+CLASS_NAMES = {INTERACTIVE: "interactive", SPECULATIVE: "speculative", EVAL: "eval"}
+
+# Output allowance added to the prompt estimate; corrected from usage_metadata after the call
+OUTPUT_ESTIMATE = int(os.getenv("ADMISSION_OUTPUT_ESTIMATE", "256"))
+
+class AdmissionError(RuntimeError):
+    pass
+
+class QueueFull(AdmissionError):
+    pass
+
+class DeadlineExceeded(AdmissionError):
+    pass
+
+_priority = contextvars.ContextVar("admission_priority", default=INTERACTIVE)
+
+@contextlib.contextmanager
+def priority(level):
+    """Calls made inside this block (and tasks/threads started with its context) queue at `level`."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def estimate(contents, config=None):
+    """Prompt tokens as the API will count them, roughly, plus an output allowance."""
+    texts = [contents] if isinstance(contents, str) else []
+    for content in contents if not isinstance(contents, str) else []:
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content.parts or []:
+            if part.text:
+                texts.append(part.text)
+            elif part.function_response:
+                texts.append(json.dumps(part.function_response.response))
+    if config is not None and isinstance(config.system_instruction, str):
+        texts.append(config.system_instruction)
+    return sum(estimate_tokens(text) for text in texts) + OUTPUT_ESTIMATE
+
+def _actual(usage):
+    if usage is None:
+        return None
+    return (usage.prompt_token_count or 0) + (usage.candidates_token_count or 0)
+
+# --- BUCKETS ---
+class MemoryBuckets:
+    """RPM and TPM buckets for this process. Levels may go negative after a usage correction."""
+
+    # Whether bucket calls can block on I/O (and so must stay off an event loop)
+    blocking = False
+
+    def __init__(self, rpm, tpm):
+        self.capacity = {"requests": float(rpm or 0), "tokens": float(tpm or 0)}
+        self._levels = dict(self.capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        for name, capacity in self.capacity.items():
+            if capacity:
+                self._levels[name] = min(capacity, self._levels[name] + elapsed * capacity / 60)
+
+    def take(self, tokens, floor):
+        """Debits one request and `tokens` if both stay above floor * capacity; else seconds until they would."""
+        self._refill()
+        need = {"requests": 1.0, "tokens": float(tokens)}
+        wait = 0.0
+        for name, capacity in self.capacity.items():
+            if not capacity:
+                continue
+            # A request larger than the whole bucket waits for a full bucket rather than forever
+            amount = min(need[name], capacity * (1 - floor))
+            short = amount + floor * capacity - self._levels[name]
+            if short > 0:
+                wait = max(wait, short * 60 / capacity)
+        if wait:
+            return wait
+        for name, capacity in self.capacity.items():
+            if capacity:
+                self._levels[name] -= need[name]
+        return 0.0
+
+    def adjust(self, tokens):
+        if self.capacity["tokens"]:
+            self._levels["tokens"] -= tokens
+
+    def drain(self):
+        self._refill()
+        for name in self._levels:
+            self._levels[name] = min(self._levels[name], 0.0)
+
+    def levels(self):
+        self._refill()
+        return {name: round(level, 1) for name, level in self._levels.items() if self.capacity[name]}
+
+    def set_demand(self, level):
+        pass
+
+    def other_demand(self):
+        return None
+
+class SqliteBuckets(MemoryBuckets):
+    """
+    The same buckets kept in a SQLite file shared by every process on the host.
+    Each take/adjust is one IMMEDIATE transaction; a `demand` row per process
+    records its most urgent waiting class so other processes can yield to it.
+    """
+
+    DEMAND_TTL = 5.0
+    blocking = True
+
+    def __init__(self, rpm, tpm, path):
+        super().__init__(rpm, tpm)
+        self.path = path
+        self._local = threading.local()
+        with self._tx() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS demand (pid INTEGER PRIMARY KEY, level INTEGER, updated REAL)")
+            for name, capacity in self.capacity.items():
+                db.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (name, capacity, time.time()))
+
+    @contextlib.contextmanager
+    def _tx(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _run(self, fn):
+        # Load shared levels, apply fn to them in memory, write them back, all under the file lock
+        with self._tx() as db:
+            now = time.time()
+            for name, level, updated in db.execute("SELECT name, level, updated FROM buckets"):
+                capacity = self.capacity.get(name)
+                if capacity:
+                    self._levels[name] = min(capacity, level + (now - updated) * capacity / 60)
+            self._updated = time.monotonic()
+            result = fn()
+            db.executemany("UPDATE buckets SET level = ?, updated = ? WHERE name = ?",
+                           [(level, now, name) for name, level in self._levels.items()])
+            return result
+
+    def take(self, tokens, floor):
+        return self._run(lambda: MemoryBuckets.take(self, tokens, floor))
+
+    def adjust(self, tokens):
+        self._run(lambda: MemoryBuckets.adjust(self, tokens))
+
+    def drain(self):
+        self._run(lambda: MemoryBuckets.drain(self))
+
+    def levels(self):
+        return self._run(lambda: MemoryBuckets.levels(self))
+
+    def set_demand(self, level):
+        with self._tx() as db:
+            if level is None:
+                db.execute("DELETE FROM demand WHERE pid = ?", (os.getpid(),))
+            else:
+                db.execute("INSERT OR REPLACE INTO demand VALUES (?, ?, ?)", (os.getpid(), level, time.time()))
+
+    def other_demand(self):
+        with self._tx() as db:
+            row = db.execute("SELECT MIN(level) FROM demand WHERE pid != ? AND updated > ?",
+                             (os.getpid(), time.time() - self.DEMAND_TTL)).fetchone()
+        return row[0]
+
+# --- SCHEDULER ---
+class _Ticket:
+    __slots__ = ("level", "tokens", "enqueued", "deadline")
+
+    def __init__(self, level, tokens, deadline):
+        self.level = level
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.deadline = self.enqueued + deadline
+
+class AdmissionScheduler:
+    POLL = 0.05
+
+    def __init__(self, buckets, reserve=0.2, max_queue=64, deadlines=None):
+        self.buckets = buckets
+        self.reserve = reserve
+        self.max_queue = max_queue
+        self.deadlines = {INTERACTIVE: 15.0, SPECULATIVE: 3.0, EVAL: 600.0, **(deadlines or {})}
+        self._queues = {level: deque() for level in CLASS_NAMES}
+        self._cond = threading.Condition()
+        self._waits = {level: deque(maxlen=1000) for level in CLASS_NAMES}
+        self.admitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.timed_out = defaultdict(int)
+        self.max_depth = defaultdict(int)
+        self.throttled = 0
+
+    def _enqueue(self, level, tokens):
+        with self._cond:
+            queue = self._queues[level]
+            if len(queue) >= self.max_queue:
+                self.rejected[level] += 1
+                raise QueueFull(f"{CLASS_NAMES[level]} admission queue is full ({self.max_queue} waiting)")
+            ticket = _Ticket(level, tokens, self.deadlines[level])
+            queue.append(ticket)
+            self.max_depth[level] = max(self.max_depth[level], len(queue))
+            self._publish_demand()
+            return ticket
+
+    def _publish_demand(self):
+        waiting = [level for level, queue in self._queues.items() if queue]
+        self.buckets.set_demand(min(waiting) if waiting else None)
+
+    def _try_admit(self, ticket):
+        """Under the lock: 0 once admitted, else a suggested wait in seconds."""
+        if self._queues[ticket.level][0] is not ticket:
+            return self.POLL
+        if any(self._queues[level] for level in CLASS_NAMES if level < ticket.level):
+            return self.POLL
+        if ticket.level > INTERACTIVE:
+            other = self.buckets.other_demand()
+            if other is not None and other < ticket.level:
+                return self.POLL
+        wait = self.buckets.take(ticket.tokens, 0.0 if ticket.level == INTERACTIVE else self.reserve)
+        if wait:
+            return wait
+        self._queues[ticket.level].popleft()
+        self._waits[ticket.level].append(time.monotonic() - ticket.enqueued)
+        self.admitted[ticket.level] += 1
+        self._publish_demand()
+        self._cond.notify_all()
+        return 0.0
+
+    def _abandon(self, ticket):
+        """Under the lock: drops a ticket that gave up (deadline, cancellation) so it cannot block its queue."""
+        try:
+            self._queues[ticket.level].remove(ticket)
+        except ValueError:
+            return
+        self._publish_demand()
+        self._cond.notify_all()
+
+    def _expire(self, ticket):
+        self._abandon(ticket)
+        self.timed_out[ticket.level] += 1
+        raise DeadlineExceeded(f"{CLASS_NAMES[ticket.level]} call not admitted within "
+                               f"{self.deadlines[ticket.level]:.1f}s")
+
+    def acquire(self, tokens, level=None):
+        level = _priority.get() if level is None else level
+        ticket = self._enqueue(level, tokens)
+        with tracer.span("admission") as span, self._cond:
+            try:
+                while True:
+                    wait = self._try_admit(ticket)
+                    if not wait:
+                        span.set(priority=CLASS_NAMES[level])
+                        return
+                    remaining = ticket.deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._expire(ticket)
+                    self._cond.wait(min(wait, remaining))
+            except BaseException:
+                self._abandon(ticket)
+                raise
+
+    async def _off_loop(self, fn, *args):
+        # SQLite buckets wait on a file lock (up to the busy timeout) while holding _cond;
+        # that must not stall the one event loop every session and eval worker shares
+        if self.buckets.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def _poll(self, ticket):
+        """One admission attempt: 0 once admitted, else how long to sleep before the next."""
+        with self._cond:
+            wait = self._try_admit(ticket)
+            if not wait:
+                return 0.0
+            remaining = ticket.deadline - time.monotonic()
+            if remaining <= 0:
+                self._expire(ticket)
+            return min(wait, remaining, self.POLL)
+
+    def _abandon_locked(self, ticket):
+        with self._cond:
+            self._abandon(ticket)
+
+    async def acquire_async(self, tokens, level=None):
+        level = _priority.get() if level is None else level
+        ticket = await self._off_loop(self._enqueue, level, tokens)
+        with tracer.span("admission") as span, resilience.queued():
+            try:
+                while True:
+                    wait = await self._off_loop(self._poll, ticket)
+                    if not wait:
+                        span.set(priority=CLASS_NAMES[level])
+                        return
+                    # Polled rather than signalled so the event loop thread never blocks on the condition
+                    await asyncio.sleep(wait)
+            except BaseException:
+                # Attempt timeouts and hedging cancel waiting calls; the cleanup must not be cancellable
+                if self.buckets.blocking:
+                    threading.Thread(target=self._abandon_locked, args=(ticket,), daemon=True).start()
+                else:
+                    self._abandon_locked(ticket)
+                raise
+
+    async def settle_async(self, estimated, usage):
+        await self._off_loop(self.settle, estimated, usage)
+
+    async def failed_async(self, exc):
+        await self._off_loop(self.failed, exc)
+
+    def settle(self, estimated, usage):
+        """Corrects the token bucket by the difference between the estimate and the billed tokens."""
+        actual = _actual(usage)
+        if actual is not None and actual != estimated:
+            with self._cond:
+                self.buckets.adjust(actual - estimated)
+
+    def failed(self, exc):
+        if isinstance(exc, errors.APIError) and exc.code == 429:
+            # The server disagrees with our accounting: empty the buckets so every class backs off
+            with self._cond:
+                self.throttled += 1
+                self.buckets.drain()
+
+    def snapshot(self):
+        with self._cond:
+            result = {"buckets": self.buckets.levels(), "throttled": self.throttled, "classes": {}}
+            for level, name in CLASS_NAMES.items():
+                waits = sorted(self._waits[level])
+                pick = lambda pct: round(waits[min(len(waits) - 1, int(round(pct / 100 * (len(waits) - 1))))] * 1000, 2)
+                result["classes"][name] = {
+                    "depth": len(self._queues[level]), "max_depth": self.max_depth[level],
+                    "admitted": self.admitted[level], "rejected": self.rejected[level],
+                    "timed_out": self.timed_out[level],
+                    "wait_ms": {"p50": pick(50), "p95": pick(95), "max": round(waits[-1] * 1000, 2)} if waits else None,
+                }
+        return result
+
+    def render(self):
+        """Prometheus text lines for the tracing metrics endpoint."""
+        snap = self.snapshot()
+        lines = ["# TYPE agent_admission_queue_depth gauge"]
+        for name, stats in snap["classes"].items():
+            lines.append(f'agent_admission_queue_depth{{class="{name}"}} {stats["depth"]}')
+        for metric in ("admitted", "rejected", "timed_out"):
+            lines.append(f"# TYPE agent_admission_{metric}_total counter")
+            for name, stats in snap["classes"].items():
+                lines.append(f'agent_admission_{metric}_total{{class="{name}"}} {stats[metric]}')
+        lines.append("# TYPE agent_admission_throttled_total counter")
+        lines.append(f"agent_admission_throttled_total {snap['throttled']}")
+        return lines
+
+# --- CLIENT ---
+class _Models:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, model, contents, config=None):
+        scheduler, inner = self._owner.scheduler, self._owner.inner
+        tokens = estimate(contents, config)
+        scheduler.acquire(tokens)
+        try:
+            response = inner.models.generate_content(model=model, contents=contents, config=config)
+        except Exception as e:
+            scheduler.failed(e)
+            raise
+        scheduler.settle(tokens, response.usage_metadata)
+        return response
+
+    def generate_content_stream(self, model, contents, config=None):
+        scheduler, inner = self._owner.scheduler, self._owner.inner
+        tokens = estimate(contents, config)
+        scheduler.acquire(tokens)
+        usage = None
+        try:
+            for chunk in inner.models.generate_content_stream(model=model, contents=contents, config=config):
+                usage = chunk.usage_metadata or usage
+                yield chunk
+        except Exception as e:
+            scheduler.failed(e)
+            raise
+        finally:
+            scheduler.settle(tokens, usage)
+
+class _AsyncModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def generate_content(self, model, contents, config=None):
+        scheduler, inner = self._owner.scheduler, self._owner.inner
+        tokens = estimate(contents, config)
+        await scheduler.acquire_async(tokens)
+        try:
+            response = await inner.aio.models.generate_content(model=model, contents=contents, config=config)
+        except Exception as e:
+            await scheduler.failed_async(e)
+            raise
+        await scheduler.settle_async(tokens, response.usage_metadata)
+        return response
+
+class _Aio:
+    def __init__(self, owner):
+        self.models = _AsyncModels(owner)
+
+class ScheduledClient:
+    """Wraps a google-genai client so its generate_content calls go through `scheduler`."""
+
+    def __init__(self, inner, scheduler):
+        self.inner = inner
+        self.scheduler = scheduler
+        self.models = _Models(self)
+        self.aio = _Aio(self)
+        self.caches = inner.caches
+
+def _scheduler_from_env():
+    rpm = float(os.getenv("GEMINI_RPM", "0"))
+    tpm = float(os.getenv("GEMINI_TPM", "0"))
+    if not rpm and not tpm:
+        return None
+    path = os.getenv("ADMISSION_DB")
+    buckets = SqliteBuckets(rpm, tpm, path) if path else MemoryBuckets(rpm, tpm)
+    deadlines = {level: float(os.environ[f"ADMISSION_DEADLINE_{name.upper()}"])
+                 for level, name in CLASS_NAMES.items() if os.getenv(f"ADMISSION_DEADLINE_{name.upper()}")}
+    return AdmissionScheduler(buckets, reserve=float(os.getenv("ADMISSION_RESERVE", "0.2")),
+                              max_queue=int(os.getenv("ADMISSION_QUEUE", "64")), deadlines=deadlines)
+
+scheduler = _scheduler_from_env()
+if scheduler is not None:
+    tracer.add_collector(scheduler.render)
+
+def from_env(client):
+    """`client` behind the shared scheduler, or unchanged when no quota is configured."""
+    if client is None or scheduler is None:
+        return client
+    return ScheduledClient(client, scheduler)
@@ -4,36 +4,65 @@ Description: Workspace Upsell Demo - Sidebar Chat + Exit Flow.
 Implements Generative UI for dynamic chips and clean state management.
 """
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import logic
-import base64
 import os
+import session_store
+from speculation import Speculator
+from tracing import tracer
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(layout="wide", page_title="Contract Draft - Google Docs")
 
-def get_base64_image(image_path):
-    if not os.path.exists(image_path): return None
-    with open(image_path, 'rb') as f: return base64.b64encode(f.read()).decode()
+# Served by Streamlit's static file handler (enableStaticServing) so the browser fetches and caches it once
+BG_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "contract_draft.png")
+BG_IMAGE_URL = "app/static/contract_draft.png"
 
-bg_base64 = get_base64_image("Contract Draft.png")
+# Opt-in: pre-generate replies for the chips on screen (one pool shared by all sessions)
+@st.cache_resource
+def get_speculator():
+    speculator = Speculator(
+        logic.get_gemini_response,
+        max_workers=int(os.getenv("SPECULATIVE_WORKERS", "4")),
+        per_session_cap=int(os.getenv("SPECULATIVE_MAX_BRANCHES", "3")),
+    )
+    # Hit rate and wasted calls on the tracing metrics endpoint, next to the per-turn traces
+    tracer.add_collector(speculator.render)
+    return speculator
+
+speculator = get_speculator() if os.getenv("SPECULATIVE_CHIPS", "0") == "1" else None
 
 # --- 2. STATE MANAGEMENT ---
-if 'view' not in st.session_state: st.session_state.view = "PRESCREEN"
-if 'chat_open' not in st.session_state: st.session_state.chat_open = False
-if 'history' not in st.session_state:
-    first_msg = "From booking the initial client consultation to getting the final proposal signed, which part of the process creates the most administrative friction for your team?"
-    st.session_state.history = [{"role": "bot", "text": first_msg}]
-if 'suggestions' not in st.session_state:
-    st.session_state.suggestions = [
-        "Playing calendar ping-pong",
-        "Managing client contracts"
-    ]
+# Sessions live in a store keyed by the ?sid= query param rather than in st.session_state,
+# so a reconnect served by another replica (SESSION_STORE_PATH on shared disk) resumes the chat
+@st.cache_resource
+def get_session_store():
+    return session_store.from_env()
+
+store = get_session_store()
+
+def current_chat():
+    chat = store.get(st.query_params.get("sid", ""))
+    if chat is None:
+        chat = store.create()
+        chat.meta.update(view="PRESCREEN", chat_open=False)
+        st.query_params["sid"] = chat.session_id
+    return chat
+
+def update_view(chat, **meta):
+    with store.lock(chat.session_id):
+        chat.meta.update(meta)
+        store.save(chat)
+    st.rerun()
+
+chat = current_chat()
 
 # --- 3. CSS INJECTION ---
-def inject_css():
-    bg_rule = f'background-image: url("data:image/png;base64,{bg_base64}"); background-size: cover; background-position: top center; background-attachment: fixed;' if bg_base64 else 'background-color: #f1f3f4;'
+@st.cache_resource
+def build_css():
+    bg_rule = f'background-image: url("{BG_IMAGE_URL}"); background-size: cover; background-position: top center; background-attachment: fixed;' if os.path.exists(BG_IMAGE_PATH) else 'background-color: #f1f3f4;'
 
-    st.markdown(f"""
+    return f"""
         <style>
             [data-testid="stAppViewContainer"] {{ {bg_rule} }}
             [data-testid="stHeader"], [data-testid="stToolbar"] {{ display: none; }}
@@ -70,7 +99,10 @@ def inject_css():
             }}
             .ended-card {{ background: white; padding: 40px; border-radius: 16px; text-align: center; max-width: 400px; margin: 100px auto; }}
         </style>
-    """, unsafe_allow_html=True)
+    """
+
+def inject_css():
+    st.markdown(build_css(), unsafe_allow_html=True)
 
 # --- 4. RENDERERS ---
 def render_prescreen():
@@ -95,8 +127,7 @@ def render_prescreen():
             st.info("**🎯 The Upgrade Goal:** Upsell to **Business Standard** ($12/mo) by diagnosing and solving her biggest operational friction.")
             st.markdown("<br>", unsafe_allow_html=True)
             if st.button("🚀 Enter Workspace Demo", type="primary", use_container_width=True):
-                st.session_state.view = "DEMO"
-                st.rerun()
+                update_view(chat, view="DEMO")
 
 def render_ended():
     inject_css()
@@ -104,25 +135,74 @@ def render_ended():
     c1, c2, c3 = st.columns([1, 1, 1])
     with c2:
         if st.button("Return to Start", type="primary", use_container_width=True):
-            st.session_state.clear()
+            chat.end(speculator)
+            store.delete(chat.session_id)
+            st.query_params.clear()
             st.rerun()
 
-def process_user_input(user_text):
-    st.session_state.history.append({"role": "user", "text": user_text})
-    with st.spinner("Typing..."):
-        reply_text, score, new_suggestions = logic.get_gemini_response(
-            user_input=user_text,
-            chat_history=st.session_state.history[:-1]
+def process_user_input(chat, user_text):
+    st.markdown(f"<div class='user-bubble'>{user_text}</div>", unsafe_allow_html=True)
+    # Render the bot bubble token-by-token instead of blocking on the full JSON
+    bubble = st.empty()
+    bubble.markdown("<div class='bot-bubble'>Typing...</div>", unsafe_allow_html=True)
+    # A second run for this session (double submit, two tabs) waits here and then answers after this turn
+    with store.lock(chat.session_id):
+        chat = store.get(chat.session_id) or chat
+        chat.reply(
+            user_text,
+            speculator=speculator,
+            on_delta=lambda shown: bubble.markdown(f"<div class='bot-bubble'>{shown}</div>", unsafe_allow_html=True)
         )
-    st.session_state.history.append({"role": "bot", "text": reply_text})
-    st.session_state.suggestions = new_suggestions
-    st.rerun()
-
+        # One write per turn: just the two new messages and the chips
+        store.save(chat)
+    try:
+        # Only the chat fragment is redrawn; the page and its CSS stay as they are
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        # Fragment scope is only allowed inside a fragment rerun, not when the fragment ran with the full page
+        st.rerun()
+
+
+@st.fragment
+def render_chat():
+    st.markdown("""<div class="chat-header"><span>Google Workspace Guide</span></div>""",
+                unsafe_allow_html=True)
+    st.markdown("""<div class="legal-text">This product uses AI.</div>""", unsafe_allow_html=True)
+
+    # Looked up again on fragment reruns, which reuse the chat of the last full run otherwise
+    chat = current_chat()
+    for msg in chat.history:
+        css_class = "user-bubble" if msg['role'] == "user" else "bot-bubble"
+        st.markdown(f"<div class='{css_class}'>{msg['text']}</div>", unsafe_allow_html=True)
+
+    st.markdown("<br>", unsafe_allow_html=True)
+
+    if chat.suggestions:
+        unique_chips = list(dict.fromkeys(chat.suggestions))
+        if speculator:
+            chat.speculate(speculator, unique_chips)
+        for i, opt in enumerate(unique_chips):
+            if st.button(opt, key=f"dynamic_chip_{i}_{opt}"):
+                # Restored the End Chat routing functionality
+                if opt.lower() == "end chat":
+                    chat.end(speculator)
+                    update_view(chat, view="ENDED")
+                else:
+                    process_user_input(chat, opt)
+
+    user_text = st.chat_input("Add details or ask a question...")
+    if user_text:
+        process_user_input(chat, user_text)
+
+    st.markdown("<br><hr>", unsafe_allow_html=True)
+    if st.button("Close Chat", type="secondary"):
+        chat.end(speculator)
+        update_view(chat, view="ENDED")
 
 def render_demo():
     inject_css()
 
-    if not st.session_state.chat_open:
+    if not chat.meta["chat_open"]:
         st.markdown("""
             <div style="position: fixed; bottom: 100px; right: 30px; background: white; padding: 16px; border-radius: 12px; box-shadow: 0 4px 12px rgba(0,0,0,0.15); max-width: 250px; font-family: sans-serif; font-size: 14px; color: #3c4043; z-index: 999;">
                 Hi Sarah! 👋 I'm powered by Google AI. As the owner of Sarah Designs, I know you wear a lot of hats. Together, we can streamline your workflow and save you time. Interested in exploring how?
@@ -131,44 +211,15 @@ def render_demo():
 
         st.markdown('<div id="fix-chat-button"></div>', unsafe_allow_html=True)
         if st.button("💬 Let's chat", key="open_chat"):
-            st.session_state.chat_open = True
-            st.rerun()
+            update_view(chat, chat_open=True)
 
-    if st.session_state.chat_open:
+    if chat.meta["chat_open"]:
         with st.sidebar:
-            st.markdown("""<div class="chat-header"><span>Google Workspace Guide</span></div>""",
-                        unsafe_allow_html=True)
-            st.markdown("""<div class="legal-text">This product uses AI.</div>""", unsafe_allow_html=True)
-
-            for msg in st.session_state.history:
-                css_class = "user-bubble" if msg['role'] == "user" else "bot-bubble"
-                st.markdown(f"<div class='{css_class}'>{msg['text']}</div>", unsafe_allow_html=True)
-
-            st.markdown("<br>", unsafe_allow_html=True)
+            render_chat()
 
-            if st.session_state.suggestions:
-                unique_chips = list(dict.fromkeys(st.session_state.suggestions))
-                for i, opt in enumerate(unique_chips):
-                    if st.button(opt, key=f"dynamic_chip_{i}_{opt}"):
-                        # Restored the End Chat routing functionality
-                        if opt.lower() == "end chat":
-                            st.session_state.view = "ENDED"
-                            st.rerun()
-                        else:
-                            process_user_input(opt)
-
-            user_text = st.chat_input("Add details or ask a question...")
-            if user_text:
-                process_user_input(user_text)
-
-            st.markdown("<br><hr>", unsafe_allow_html=True)
-            if st.button("Close Chat", type="secondary"):
-                st.session_state.view = "ENDED"
-                st.rerun()
-
-if st.session_state.view == "PRESCREEN":
+if chat.meta["view"] == "PRESCREEN":
     render_prescreen()
-elif st.session_state.view == "ENDED":
+elif chat.meta["view"] == "ENDED":
     render_ended()
 else:
     render_demo()
\ No newline at end of file
@@ -0,0 +1,441 @@
+"""
+File: benchmarks.py
+Description: Latency micro-benchmarks for the agent pipeline.
+Runs against mock_gemini.FakeClient so no API key or network is needed.
+Usage: python benchmarks.py <benchmark> [options]
+"""
+import os
+import json
+import time
+import asyncio
+import random
+import sqlite3
+import argparse
+import contextlib
+import tempfile
+import statistics
+import tracemalloc
+
+import logic
+import mock_gemini
+import intent_router
+from eval_judge import TEST_CASES
+from kb_index import KnowledgeBaseIndex
+from history import HistoryManager
+from chat_session import ChatSession
+from session_store import SessionStore, SqliteBackend
+from resilience import RetryPolicy, LatencyTracker
+from text_utils import estimate_tokens
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def _summary(label, samples, unit="ms", scale=1000.0):
+    print(f"{label:<34} p50 {_percentile(samples, 50) * scale:8.2f}{unit} | "
+          f"p95 {_percentile(samples, 95) * scale:8.2f}{unit} | mean {statistics.mean(samples) * scale:8.2f}{unit}")
+
+# --- STREAMING: time to first visible token ---
+def bench_stream(args):
+    logic.client = mock_gemini.FakeClient(
+        first_token_latency=args.first_token_latency,
+        chunk_latency=args.chunk_latency,
+        function_call_rate=args.function_call_rate,
+    )
+    blocking, first_token, stream_total = [], [], []
+    for _ in range(args.runs):
+        start = time.monotonic()
+        logic.get_gemini_response("How much is it?", [])
+        blocking.append(time.monotonic() - start)
+
+        stream = logic.get_gemini_response_stream("How much is it?", [])
+        for _delta in stream:
+            pass
+        first_token.append(stream.time_to_first_token)
+        stream_total.append(time.monotonic() - stream.started_at)
+
+    print(f"Streaming vs blocking over {args.runs} runs (fake client)")
+    _summary("blocking: first visible text", blocking)
+    _summary("streaming: first visible token", first_token)
+    _summary("streaming: full reply", stream_total)
+
+# --- KNOWLEDGE BASE: indexed lookup vs re-reading the whole file ---
+KB_TOPICS = ["pricing discount", "eSignature legally binding", "Meet participants recording",
+             "phishing spam security", "storage design files", "Outlook calendar sync", "Stripe payments"]
+
+def _synthetic_kb(path, bullets):
+    rng = random.Random(7)
+    with open("knowledge_base.txt") as f:
+        base = f.read()
+    vocab = sorted({w for w in base.lower().split() if w.isalpha() and len(w) > 3})
+    lines = [base, ""]
+    per_section = 25
+    for section in range(bullets // per_section + 1):
+        lines.append(f"## SYNTHETIC SECTION {section}: {' '.join(rng.sample(vocab, 3)).upper()}")
+        for _ in range(per_section):
+            lines.append("* " + " ".join(rng.choice(vocab) for _ in range(rng.randint(12, 24))) + ".")
+        lines.append("")
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+def bench_kb(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "knowledge_base.txt")
+        _synthetic_kb(path, args.bullets)
+        with open(path) as f:
+            full = f.read()
+
+        legacy = []
+        for topic in KB_TOPICS * args.rounds:
+            start = time.monotonic()
+            with open(path) as f:
+                f.read()
+            legacy.append(time.monotonic() - start)
+
+        index = KnowledgeBaseIndex(path)
+        start = time.monotonic()
+        index.lookup("warmup")
+        build = time.monotonic() - start
+
+        lookups, returned = [], []
+        for topic in KB_TOPICS * args.rounds:
+            start = time.monotonic()
+            text = index.lookup(topic, k=args.top_k, token_budget=args.token_budget)
+            lookups.append(time.monotonic() - start)
+            returned.append(estimate_tokens(text))
+
+    print(f"Synthetic KB: {args.bullets}+ bullets, {len(full) / 1024:.0f} KB, ~{estimate_tokens(full)} tokens")
+    print(f"Index build (once per mtime change): {build * 1000:.1f}ms")
+    _summary("legacy: re-read whole file", legacy)
+    _summary("indexed: top-k lookup", lookups)
+    print(f"Returned tokens per lookup: legacy {estimate_tokens(full)} | indexed mean "
+          f"{statistics.mean(returned):.0f}, max {max(returned)} (budget {args.token_budget})")
+
+# --- PREFIX CACHE: per-turn prompt build time and billed input tokens ---
+def _replay_conversation(turns, cached, function_call_rate):
+    logic.client = mock_gemini.FakeClient(first_token_latency=0, chunk_latency=0,
+                                          function_call_rate=function_call_rate)
+    logic.PROMPT_CACHE = cached
+    logic.prefix_cache.clear()
+    session_id = "bench-cached" if cached else None
+    history, build, uncached = [], [], []
+    for turn in range(turns):
+        user_text = f"Turn {turn}: we still juggle Calendly, DocuSign and Zoom for every new client."
+        start = time.monotonic()
+        logic._prepare(user_text, history, session_id)
+        build.append(time.monotonic() - start)
+
+        logic.client.usage.clear()
+        reply, _score, _chips = logic.get_gemini_response(user_text, history, session_id)
+        uncached.append(sum(u.prompt_token_count - u.cached_content_token_count for u in logic.client.usage))
+        history += [{"role": "user", "text": user_text}, {"role": "bot", "text": reply}]
+    return build, uncached
+
+def bench_prefix(args):
+    print(f"{args.turns}-turn conversation, function-call rate {args.function_call_rate} (fake client)")
+    for label, cached in (("inline prompt", False), ("prefix cache", True)):
+        build, uncached = _replay_conversation(args.turns, cached, args.function_call_rate)
+        _summary(f"{label}: prompt build", build)
+        print(f"{label}: uncached input tokens/turn  first {uncached[0]} | last {uncached[-1]} | "
+              f"mean {statistics.mean(uncached):.0f}")
+    logic.PROMPT_CACHE = False
+
+# --- INTENT ROUTER: latency and precision/recall against TEST_CASES ---
+# Hand-labelled ground truth; cases not listed are OTHER
+ROUTER_LABELS = {
+    "T1": "EXIT", "T2": "EXIT", "T4": "EXIT", "T5": "EXIT", "M3": "EXIT",
+    "D1": "READY", "D3": "READY", "D4": "READY", "D5": "READY", "M5": "READY",
+    "M2": "BINARY",
+    "A3": "INJECTION",
+}
+# Sales turns that share words with the EXIT/READY patterns; all should stay OTHER and reach the model
+ROUTER_NEGATIVES = [
+    "Can I cancel the plan anytime if it does not work out?",
+    "Can I speak to a manager about a volume discount?",
+    "I'm not interested in Zoom, how does Meet compare?",
+    "My clients complain about signing PDFs, does eSignature fix that?",
+    "Our office manager handles billing, can she see the invoices?",
+    "Do we have to end the chat to start the trial later?",
+    "What happens to our files if we cancel the subscription?",
+    "We're not interested in more storage, just scheduling. What's included?",
+    "Is there a human support line if something breaks?",
+    "Would my team lose anything if we stop paying for Starter?",
+]
+
+def bench_router(args):
+    cases = [(test["id"], test["input"]) for test in TEST_CASES]
+    cases += [(f"NEG{i}", text) for i, text in enumerate(ROUTER_NEGATIVES, 1)]
+    latencies = []
+    for _ in range(args.rounds):
+        for _case_id, text in cases:
+            start = time.perf_counter()
+            intent_router.classify(text)
+            latencies.append(time.perf_counter() - start)
+    print(f"Router over {len(TEST_CASES)} TEST_CASES + {len(ROUTER_NEGATIVES)} negatives x {args.rounds} rounds")
+    _summary("classify()", latencies, unit="us", scale=1e6)
+
+    predicted = {case_id: intent_router.classify(text).label for case_id, text in cases}
+    print(f"\n{'label':<10} {'precision':>9} {'recall':>7}  support")
+    for label in (intent_router.EXIT, intent_router.READY, intent_router.BINARY, intent_router.INJECTION):
+        truth = {case_id for case_id, _ in cases if ROUTER_LABELS.get(case_id, "OTHER") == label}
+        flagged = {case_id for case_id, got in predicted.items() if got == label}
+        precision = len(truth & flagged) / len(flagged) if flagged else 1.0
+        recall = len(truth & flagged) / len(truth) if truth else 1.0
+        print(f"{label:<10} {precision:>9.2f} {recall:>7.2f}  {len(truth)}")
+    errors = [f"{case_id}: {ROUTER_LABELS.get(case_id, 'OTHER')} -> {got}" for case_id, got in predicted.items()
+              if got != ROUTER_LABELS.get(case_id, "OTHER")]
+    print("Misrouted: " + (", ".join(errors) if errors else "none"))
+    short_circuited = [case_id for case_id, text in cases if logic._short_circuit(intent_router.classify(text), text)]
+    print(f"Short-circuited without a model call: {', '.join(short_circuited)}")
+    wrongly = [case_id for case_id in short_circuited if ROUTER_LABELS.get(case_id) != intent_router.EXIT]
+    print(f"Short-circuited but not an exit: {', '.join(wrongly) if wrongly else 'none'}")
+
+# --- HISTORY WINDOWING: per-turn input size over long sessions ---
+def _replay_session(turns, managed):
+    logic.client = mock_gemini.FakeClient(first_token_latency=0, chunk_latency=0)
+    manager = HistoryManager(background=False)
+    history, prompt_tokens, append_times = [], [], []
+    for turn in range(turns):
+        user_text = (f"Turn {turn}: our clients keep asking for contract changes and we re-export PDFs "
+                     f"each time, which means another round of DocuSign envelopes and follow-ups.")
+        if managed:
+            summary, window = manager.window()
+        else:
+            summary, window = None, history
+        logic.client.usage.clear()
+        reply, _score, _chips = logic.get_gemini_response(user_text, window, summary=summary)
+        prompt_tokens.append(logic.client.usage[-1].prompt_token_count)
+        for msg in ({"role": "user", "text": user_text}, {"role": "bot", "text": reply}):
+            history.append(msg)
+            start = time.perf_counter()
+            manager.append(msg)
+            append_times.append(time.perf_counter() - start)
+    return prompt_tokens, append_times
+
+def bench_history(args):
+    for turns in args.turns:
+        print(f"{turns}-turn synthetic session (fake client)")
+        for label, managed in (("full history", False), ("windowed", True)):
+            tokens, append_times = _replay_session(turns, managed)
+            checkpoints = " | ".join(f"turn {t}: {tokens[t - 1]}" for t in (1, 10, turns // 2, turns))
+            print(f"  {label:<13} input tokens  {checkpoints}")
+        _summary("  HistoryManager.append()", append_times, unit="us", scale=1e6)
+
+# --- RESILIENCE: retries and hedging against injected errors and stragglers ---
+async def _timed_requests(count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.monotonic()
+            reply = await logic.get_gemini_response_async(f"Question {i}: how much storage do we get?", [])
+            return time.monotonic() - start, reply[0] != logic.ERROR_REPLY[0]
+
+    return await asyncio.gather(*(one(i) for i in range(count)))
+
+def bench_resilience(args):
+    policies = [
+        ("no retry", RetryPolicy(attempts=1, attempt_timeout=args.timeout)),
+        ("retry", RetryPolicy(attempts=3, attempt_timeout=args.timeout, base_delay=0.05)),
+        ("retry + hedge", RetryPolicy(attempts=3, attempt_timeout=args.timeout, base_delay=0.05,
+                                      hedge=True, hedge_delay=args.latency * 3)),
+    ]
+    print(f"{args.requests} requests, {args.latency * 1000:.0f}ms base latency, {args.error_rate:.0%} errors, "
+          f"{args.tail_rate:.0%} stragglers (+{args.tail_latency:.1f}s), {args.timeout:.1f}s attempt deadline")
+    previous = logic.retry_policy, logic.latency_tracker
+    try:
+        for label, policy in policies:
+            logic.client = mock_gemini.FakeClient(first_token_latency=args.latency, chunk_latency=0,
+                                                  error_rate=args.error_rate, tail_rate=args.tail_rate,
+                                                  tail_latency=args.tail_latency, seed=11)
+            logic.retry_policy, logic.latency_tracker = policy, LatencyTracker()
+            results = asyncio.run(_timed_requests(args.requests, args.concurrency))
+            latencies = [latency for latency, _ok in results]
+            ok = sum(1 for _latency, good in results if good)
+            print(f"{label:<14} success {ok / len(results):6.1%} | upstream calls {logic.client.calls:4d} | "
+                  f"p50 {_percentile(latencies, 50) * 1000:7.1f}ms | p95 {_percentile(latencies, 95) * 1000:7.1f}ms | "
+                  f"p99 {_percentile(latencies, 99) * 1000:7.1f}ms")
+    finally:
+        logic.retry_policy, logic.latency_tracker = previous
+
+# --- RENDER: Streamlit rerun time and bytes per chat interaction ---
+SIDEBAR_CONTAINER = 1   # ForwardMsg.metadata.delta_path[0] for st.sidebar
+
+def _record_runs(runs):
+    """Patches ForwardMsgQueue so every script run logs its duration, bytes and the sidebar's share of them."""
+    from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+    enqueue, clear = ForwardMsgQueue.enqueue, ForwardMsgQueue.clear
+
+    def counting_enqueue(self, msg):
+        if runs:
+            size = msg.ByteSize()
+            runs[-1]["bytes"] += size
+            if not msg.HasField("delta") or msg.metadata.delta_path[:1] == [SIDEBAR_CONTAINER]:
+                runs[-1]["sidebar_bytes"] += size
+            runs[-1]["end"] = time.perf_counter()
+        return enqueue(self, msg)
+
+    def segmenting_clear(self, *args, **kwargs):
+        now = time.perf_counter()
+        runs.append({"bytes": 0, "sidebar_bytes": 0, "start": now, "end": now})
+        return clear(self, *args, **kwargs)
+
+    ForwardMsgQueue.enqueue, ForwardMsgQueue.clear = counting_enqueue, segmenting_clear
+
+    def restore():
+        ForwardMsgQueue.enqueue, ForwardMsgQueue.clear = enqueue, clear
+    return restore
+
+def bench_render(args):
+    from streamlit.testing.v1 import AppTest
+    logic.client = mock_gemini.FakeClient(first_token_latency=0, chunk_latency=0)
+    at = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"), default_timeout=60)
+    at.run()
+    at.button[0].click().run()
+    at.button(key="open_chat").click().run()
+
+    runs = []
+    restore = _record_runs(runs)
+    try:
+        for _ in range(args.clicks):
+            at.sidebar.button[0].click().run()
+    finally:
+        restore()
+
+    # AppTest always replays a click as a full-page run. In the browser a click inside the
+    # chat fragment reruns only the fragment, which resends just the sidebar's deltas.
+    print(f"{args.clicks} chip clicks, {len(runs)} script runs ({len(runs) / args.clicks:.0f} per click)")
+    _summary("full-page run: duration", [r["end"] - r["start"] for r in runs])
+    _summary("full-page run: bytes sent", [r["bytes"] for r in runs], unit="B", scale=1.0)
+    _summary("chat sidebar only: bytes sent", [r["sidebar_bytes"] for r in runs], unit="B", scale=1.0)
+
+# --- SESSIONS: memory per idle session and store read/write latency ---
+def _idle_sessions(count, turns):
+    """`count` sessions cloned from real `turns`-turn conversations, one per TEST_CASES opener."""
+    templates = []
+    for test in TEST_CASES[:8]:
+        chat = ChatSession()
+        for _ in range(turns):
+            chat.reply(test["input"])
+        templates.append(json.dumps([chat.history, chat.suggestions]))
+    # Decoded per session so no two sessions share message strings, as with real visitors
+    return [ChatSession(history=history, suggestions=chips, meta={"view": "DEMO", "chat_open": True})
+            for history, chips in (json.loads(templates[i % len(templates)]) for i in range(count))]
+
+def _traced(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return kept, used
+
+def _db_size(path):
+    """Bytes a SQLite database takes on disk once its WAL is folded back into the main file."""
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+def bench_sessions(args):
+    logic.client = mock_gemini.FakeClient(first_token_latency=0, chunk_latency=0)
+    sessions, in_process = _traced(lambda: {s.session_id: s for s in _idle_sessions(args.sessions, args.turns)})
+    ids = list(sessions)
+    print(f"{args.sessions} idle sessions of {args.turns} turns, LRU of {args.cache}")
+    print(f"  st.session_state (all in memory)  {in_process / args.sessions / 1024:8.1f} KB/session")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sessions.db")
+        store = SessionStore(SqliteBackend(path), max_entries=args.cache)
+        first_saves = []
+        for session in sessions.values():
+            start = time.perf_counter()
+            store.save(session)
+            first_saves.append(time.perf_counter() - start)
+        del sessions, store
+
+        # A fresh process: nothing cached, every first access is a lazy load
+        store, resident = _traced(lambda: SessionStore(SqliteBackend(path), max_entries=args.cache))
+        sample = random.Random(0).sample(ids, min(args.rounds, len(ids)))
+        cold, warm, turn_saves = [], [], []
+        for sid in sample:
+            start = time.perf_counter()
+            session = store.get(sid)
+            cold.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            store.get(sid)
+            warm.append(time.perf_counter() - start)
+            session.reply("Pricing")
+            start = time.perf_counter()
+            store.save(session)
+            turn_saves.append(time.perf_counter() - start)
+        _, loaded = _traced(lambda: [store.get(sid) for sid in ids[:args.cache]])
+        resident += loaded
+        print(f"  session store (LRU resident)      {resident / args.sessions / 1024:8.1f} KB/session "
+              f"({resident / 1024 / 1024:.1f} MB for {len(store)} live)")
+        print(f"  session store (SQLite on disk)    {_db_size(path) / args.sessions / 1024:8.1f} KB/session")
+        _summary("  first save (full transcript)", first_saves)
+        _summary("  per-turn save (2 new messages)", turn_saves)
+        _summary("  get(): cold, lazy load", cold)
+        _summary("  get(): warm, version check", warm)
+        print(f"  store: {store.loads} loads, {store.hits} hits, {store.saves} saves, {store.evictions} evictions")
+
+def main(argv=None):
+    # Every benchmark measures the model path, so replies must not come from the response cache
+    logic.RESPONSE_CACHE = False
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    stream = sub.add_parser("stream", help="Time-to-first-visible-token of streamed vs blocking replies.")
+    stream.add_argument("--runs", type=int, default=20)
+    stream.add_argument("--first-token-latency", type=float, default=0.2)
+    stream.add_argument("--chunk-latency", type=float, default=0.01)
+    stream.add_argument("--function-call-rate", type=float, default=0.0)
+    stream.set_defaults(func=bench_stream)
+
+    kb = sub.add_parser("kb", help="Knowledge-base lookup latency and returned tokens on a synthetic KB.")
+    kb.add_argument("--bullets", type=int, default=10000)
+    kb.add_argument("--rounds", type=int, default=30)
+    kb.add_argument("--top-k", type=int, default=3)
+    kb.add_argument("--token-budget", type=int, default=600)
+    kb.set_defaults(func=bench_kb)
+
+    prefix = sub.add_parser("prefix", help="Prompt build time and uncached input tokens with/without prefix caching.")
+    prefix.add_argument("--turns", type=int, default=100)
+    prefix.add_argument("--function-call-rate", type=float, default=0.3)
+    prefix.set_defaults(func=bench_prefix)
+
+    router = sub.add_parser("router", help="Intent router latency and precision/recall on TEST_CASES.")
+    router.add_argument("--rounds", type=int, default=200)
+    router.set_defaults(func=bench_router)
+
+    history = sub.add_parser("history", help="Per-turn input tokens with full history vs the windowed manager.")
+    history.add_argument("--turns", type=int, nargs="+", default=[50, 200])
+    history.set_defaults(func=bench_history)
+
+    resilience = sub.add_parser("resilience", help="Success rate and tail latency with retries and hedging.")
+    resilience.add_argument("--requests", type=int, default=400)
+    resilience.add_argument("--concurrency", type=int, default=50)
+    resilience.add_argument("--latency", type=float, default=0.05)
+    resilience.add_argument("--error-rate", type=float, default=0.05)
+    resilience.add_argument("--tail-rate", type=float, default=0.05)
+    resilience.add_argument("--tail-latency", type=float, default=1.0)
+    resilience.add_argument("--timeout", type=float, default=2.0)
+    resilience.set_defaults(func=bench_resilience)
+
+    render = sub.add_parser("render", help="Streamlit rerun duration and bytes sent per chat interaction.")
+    render.add_argument("--clicks", type=int, default=10)
+    render.set_defaults(func=bench_render)
+
+    sessions = sub.add_parser("sessions", help="Memory per idle session and session-store read/write latency.")
+    sessions.add_argument("--sessions", type=int, default=3000)
+    sessions.add_argument("--turns", type=int, default=3)
+    sessions.add_argument("--cache", type=int, default=256)
+    sessions.add_argument("--rounds", type=int, default=300)
+    sessions.set_defaults(func=bench_sessions)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+File: cascade.py
+Description: Two-tier model cascade for agent turns.
+Turns start on a fast, cheap model; local signals send them to the strong
+model (GEMINI_MODEL) instead: an objection or competitor mention, a long or
+multi-question message, or an injection/exit intent the router was not sure
+enough to short-circuit. After a fast call, a tool request, malformed JSON or
+a low-confidence reply escalates the rest of the turn. Routing is decided
+from the text in microseconds; no model call is made here.
+"""
+import os
+import re
+from collections import namedtuple
+
+import intent_router
+
+FAST = "fast"
+STRONG = "strong"
+
+ENABLED = os.getenv("MODEL_CASCADE", "0") == "1"
+FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-2.0-flash-lite-001")
+MAX_FAST_WORDS = int(os.getenv("CASCADE_MAX_FAST_WORDS", "30"))
+# Mean token log-probability below which a fast reply is treated as a guess
+MIN_AVG_LOGPROB = float(os.getenv("CASCADE_MIN_AVG_LOGPROB", "-0.6"))
+
+# USD per 1M (input, output) tokens, for the eval cost comparison
+PRICES = {
+    FAST: tuple(float(p) for p in os.getenv("CASCADE_FAST_PRICE", "0.075,0.30").split(",")),
+    STRONG: tuple(float(p) for p in os.getenv("CASCADE_STRONG_PRICE", "0.10,0.40").split(",")),
+}
+
+Decision = namedtuple("Decision", ["tier", "reasons"])
+
+_OBJECTION_RE = re.compile(
+    r"\b(but|too (much|expensive|pricey)|expensive|budget|afford|match (that|it)|refund|trust|worried"
+    r"|concern(ed)?|locked into|contract with|deal ?breaker|nightmare|why (pay|should|would)|backdoor"
+    r"|docusign|calendly|microsoft|office 365|outlook|zoom|dropbox|slack|teams|hubspot)\b",
+    re.IGNORECASE)
+_ESCALATING_INTENTS = {intent_router.INJECTION, intent_router.EXIT}
+_TRAILING = " \t\n\"'*_)"
+
+def route(user_input, intent=None):
+    """Picks the tier a turn starts on, with the signals that decided it."""
+    reasons = []
+    if intent and intent.label in _ESCALATING_INTENTS:
+        reasons.append(f"intent:{intent.label}")
+    if _OBJECTION_RE.search(user_input):
+        reasons.append("objection")
+    if len(user_input.split()) > MAX_FAST_WORDS:
+        reasons.append("long")
+    if user_input.count("?") > 1:
+        reasons.append("multi_question")
+    return Decision(STRONG if reasons else FAST, reasons)
+
+def review(data, defects=(), response=None, closing_question=True):
+    """Reasons to redo a fast reply on the strong model (empty when it can stand)."""
+    reasons = []
+    text = str(data.get("text", "")).strip()
+    if "truncated" in defects:
+        reasons.append("malformed")
+    if not text:
+        reasons.append("empty")
+    elif closing_question and not text.rstrip(_TRAILING).endswith("?"):
+        reasons.append("no_question")
+    candidate = response.candidates[0] if response is not None and response.candidates else None
+    if candidate is not None and candidate.avg_logprobs is not None and candidate.avg_logprobs < MIN_AVG_LOGPROB:
+        reasons.append("low_confidence")
+    return reasons
+
+def cost(usage):
+    """USD for a {tier: [input tokens, output tokens]} mapping."""
+    return sum(tokens_in * PRICES[tier][0] / 1e6 + tokens_out * PRICES[tier][1] / 1e6
+               for tier, (tokens_in, tokens_out) in usage.items())
@@ -0,0 +1,291 @@
+"""
+File: cassette.py
+Description: Record/replay layer for every Gemini call made through a client.
+CassetteClient wraps a google-genai client (or nothing, for offline replay)
+and exposes the `models`, `aio.models` and `caches` surface logic.py and
+eval_judge.py use. Each request is fingerprinted (kind, model, contents,
+config) and its responses, tool-call turns and streamed chunks included, are
+appended to a JSONL cassette with a byte-offset index, so replay loads only
+the index and reads entries on demand.
+
+Modes (GEMINI_CASSETTE_MODE):
+  record   always call the live API and append what it returns
+  replay   serve recorded responses; an unmatched request raises CassetteMiss
+  auto     serve recorded responses; an unmatched request falls through to
+           the live API and is recorded
+Replayed calls sleep for the recorded latency times GEMINI_CASSETTE_LATENCY
+(default 0: instant).
+
+Usage: GEMINI_CASSETTE=evals.cassette GEMINI_CASSETTE_MODE=record python eval_judge.py
+       GEMINI_CASSETTE=evals.cassette python eval_judge.py
+       python cassette.py info evals.cassette
+"""
+import os
+import json
+import time
+import atexit
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+from google.genai import types
+
+FORMAT_VERSION = 1
+RECORD = "record"
+REPLAY = "replay"
+AUTO = "auto"
+MODES = (RECORD, REPLAY, AUTO)
+
+class CassetteMiss(LookupError):
+    pass
+
+def _dump(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_dump(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _dump(v) for k, v in value.items()}
+    return value.model_dump(mode="json", exclude_none=True)
+
+def fingerprint(kind, model, contents, config=None):
+    """Stable hash of everything that shapes a response."""
+    config = _dump(config) or {}
+    config.pop("http_options", None)
+    if config.get("cached_content"):
+        # Cache names are minted per run; the cached prefix itself is covered by the prompt/KB in the contents
+        config["cached_content"] = True
+    payload = json.dumps({"kind": kind, "model": model, "contents": _dump(contents), "config": config},
+                         sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class CassetteStore:
+    """
+    Append-only JSONL of {key, kind, model, latency, responses}; `path`.idx maps
+    each key to the offsets of its recordings in request order. The index is
+    rebuilt by a scan whenever it does not match the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offsets = defaultdict(list)
+        self._served = defaultdict(int)
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._load_index()
+        atexit.register(self.flush)
+
+    def _load_index(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        try:
+            with open(self.path + ".idx") as f:
+                index = json.load(f)
+            if index["header"]["format"] == FORMAT_VERSION and index["header"]["size"] == size:
+                self._offsets.update(index["offsets"])
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        if not size:
+            return
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    self._offsets[json.loads(line)["key"]].append(offset)
+                offset += len(line)
+        self._dirty = True
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self._offsets.values())
+
+    @property
+    def distinct(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def next(self, key):
+        """The next recording for `key` (repeats of a request replay in recorded order), or None."""
+        with self._lock:
+            offsets = self._offsets.get(key)
+            if not offsets:
+                self.misses += 1
+                return None
+            offset = offsets[min(self._served[key], len(offsets) - 1)]
+            self._served[key] += 1
+            self.hits += 1
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def append(self, key, kind, model, responses, latency):
+        line = json.dumps({"key": key, "kind": kind, "model": model, "latency": [round(s, 4) for s in latency],
+                           "responses": [_dump(r) for r in responses]}, separators=(",", ":"), ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write((line + "\n").encode())
+            self._offsets[key].append(offset)
+            self._dirty = True
+            self.recorded += 1
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            size = os.path.getsize(self.path)
+            payload = json.dumps({"header": {"format": FORMAT_VERSION, "size": size}, "offsets": self._offsets})
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(payload)
+            os.replace(tmp, self.path + ".idx")
+            self._dirty = False
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def open_store(path):
+    """One store per file per process, so logic.client and eval_judge.client share an index."""
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = CassetteStore(path)
+        return _stores[path]
+
+# --- CLIENT ---
+def _restore(record):
+    return [types.GenerateContentResponse.model_validate(r) for r in record["responses"]]
+
+class _Models:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, model, contents, config=None):
+        owner = self._owner
+        key = fingerprint("unary", model, contents, config)
+        record = owner._lookup(key)
+        if record is not None:
+            time.sleep(owner._delay(record["latency"][0]))
+            return _restore(record)[0]
+        started = time.perf_counter()
+        response = owner._live().models.generate_content(model=model, contents=contents, config=config)
+        owner.store.append(key, "unary", model, [response], [time.perf_counter() - started])
+        return response
+
+    def generate_content_stream(self, model, contents, config=None):
+        owner = self._owner
+        key = fingerprint("stream", model, contents, config)
+        record = owner._lookup(key)
+        if record is not None:
+            for gap, chunk in zip(record["latency"], _restore(record)):
+                time.sleep(owner._delay(gap))
+                yield chunk
+            return
+        chunks, gaps = [], []
+        last = time.perf_counter()
+        for chunk in owner._live().models.generate_content_stream(model=model, contents=contents, config=config):
+            now = time.perf_counter()
+            chunks.append(chunk)
+            gaps.append(now - last)
+            last = now
+            yield chunk
+        # Only fully consumed streams are recorded; an abandoned one would replay truncated
+        owner.store.append(key, "stream", model, chunks, gaps)
+
+class _AsyncModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def generate_content(self, model, contents, config=None):
+        owner = self._owner
+        key = fingerprint("unary", model, contents, config)
+        record = owner._lookup(key)
+        if record is not None:
+            await asyncio.sleep(owner._delay(record["latency"][0]))
+            return _restore(record)[0]
+        started = time.perf_counter()
+        response = await owner._live().aio.models.generate_content(model=model, contents=contents, config=config)
+        owner.store.append(key, "unary", model, [response], [time.perf_counter() - started])
+        return response
+
+class _Aio:
+    def __init__(self, owner):
+        self.models = _AsyncModels(owner)
+
+class _ReplayCaches:
+    """Offline stand-in for `client.caches`: names are derived from the request, nothing is uploaded."""
+
+    def create(self, model, config):
+        name = "cachedContents/cassette-" + fingerprint("cache", model, [], config)[:16]
+        return types.CachedContent(name=name, model=model, display_name=config.display_name)
+
+    def get(self, name):
+        return types.CachedContent(name=name)
+
+    def delete(self, name):
+        pass
+
+class CassetteClient:
+    def __init__(self, inner, store, mode=AUTO, latency_scale=0.0):
+        if mode not in MODES:
+            raise ValueError(f"cassette mode must be one of {MODES}, got {mode!r}")
+        self.inner = inner
+        self.store = store
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.models = _Models(self)
+        self.aio = _Aio(self)
+        self.caches = _ReplayCaches() if inner is None or mode == REPLAY else inner.caches
+
+    def _lookup(self, key):
+        if self.mode == RECORD:
+            return None
+        record = self.store.next(key)
+        if record is None and self.mode == REPLAY:
+            raise CassetteMiss(f"no recording for request {key[:12]} in {self.store.path}")
+        return record
+
+    def _live(self):
+        if self.inner is None:
+            raise CassetteMiss("request is not on the cassette and there is no live client (GOOGLE_API_KEY unset)")
+        return self.inner
+
+    def _delay(self, seconds):
+        return seconds * self.latency_scale
+
+def from_env(client):
+    """`client` wrapped per GEMINI_CASSETTE / _MODE / _LATENCY, or unchanged when no cassette is set."""
+    path = os.getenv("GEMINI_CASSETTE")
+    if not path:
+        return client
+    mode = os.getenv("GEMINI_CASSETTE_MODE", AUTO)
+    if client is None and mode == RECORD:
+        return None
+    return CassetteClient(client, open_store(path), mode, float(os.getenv("GEMINI_CASSETTE_LATENCY", "0")))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect a Gemini cassette.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    info = sub.add_parser("info", help="Entries, distinct requests and size of a cassette.")
+    info.add_argument("path")
+    args = parser.parse_args(argv)
+
+    store = CassetteStore(args.path)
+    kinds = defaultdict(int)
+    with open(args.path, "rb") as f:
+        for line in f:
+            if line.strip():
+                kinds[json.loads(line)["kind"]] += 1
+    store.flush()
+    print(f"{args.path}: {len(store)} recordings of {store.distinct} distinct requests "
+          f"({', '.join(f'{k} {v}' for k, v in sorted(kinds.items()))}), {os.path.getsize(args.path) / 1024:.1f} KB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+File: chat_session.py
+Description: UI-free chat state and turn logic shared by app.py and loadtest.py.
+A ChatSession owns one visitor's transcript, the model-facing history window,
+the chips on screen and any speculative branches; reply() runs one turn the
+same way the Streamlit sidebar does, reporting streamed text via a callback.
+"""
+import os
+import uuid
+
+import logic
+from history import HistoryManager
+from tracing import tracer
+
+FIRST_MESSAGE = "From booking the initial client consultation to getting the final proposal signed, which part of the process creates the most administrative friction for your team?"
+INITIAL_SUGGESTIONS = [
+    "Playing calendar ping-pong",
+    "Managing client contracts"
+]
+
+class ChatSession:
+    def __init__(self, session_id=None, history=None, suggestions=None, summary="", folded=0, meta=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.history = list(history) if history else [{"role": "bot", "text": FIRST_MESSAGE}]
+        self.suggestions = list(INITIAL_SUGGESTIONS if suggestions is None else suggestions)
+        # The full transcript stays in `history` for display; the model only sees this window
+        self.history_manager = HistoryManager.from_state(
+            self.history, summary, folded,
+            max_turns=int(os.getenv("HISTORY_MAX_TURNS", "6")),
+            token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "1200")),
+            summarizer=logic.summarize_history if os.getenv("HISTORY_SUMMARIZER") == "model" else None,
+        )
+        # App-level state persisted with the conversation (e.g. the Streamlit view)
+        self.meta = dict(meta or {})
+        # Messages of `history` already written to a session store, and the stored version they make up
+        self.saved = 0
+        self.version = None
+        self.speculation = {}
+        self.speculated_turn = -1
+
+    def _append(self, msg):
+        self.history.append(msg)
+        self.history_manager.append(msg)
+
+    def reply(self, user_text, speculator=None, on_delta=None):
+        """Runs one turn and returns (reply_text, score, chips); on_delta(shown_so_far) fires per streamed delta."""
+        summary, window = self.history_manager.window()
+        # How speculation went this turn, recorded on the turn's trace
+        speculation = "miss" if self.speculation else None
+        speculated = speculator.take(self.speculation, user_text, window, summary) if speculator else None
+        self._append({"role": "user", "text": user_text})
+
+        result = None
+        if speculated is not None:
+            # The reply was pre-generated while the chip was on screen; wait only for what is left
+            with tracer.trace("speculated", model=logic.model_id) as trace:
+                try:
+                    result = speculated.result()
+                except Exception:
+                    result = None
+                if result is not None and result[0] == logic.ERROR_REPLY[0]:
+                    # A failed guess (e.g. shed by admission control) must not cost the user a working reply
+                    result = None
+                speculation = "hit" if result is not None else "failed"
+                trace.set(speculation=speculation)
+        if result is not None:
+            reply_text, score, chips = result
+        else:
+            stream = logic.get_gemini_response_stream(
+                user_input=user_text,
+                chat_history=window,
+                session_id=self.session_id,
+                summary=summary,
+                trace_attrs={"speculation": speculation} if speculation else None
+            )
+            shown = ""
+            for delta in stream:
+                shown += delta
+                if on_delta:
+                    on_delta(shown)
+            reply_text, score, chips = stream.result
+
+        self._append({"role": "bot", "text": reply_text})
+        self.suggestions = chips
+        return reply_text, score, chips
+
+    def speculate(self, speculator, chips):
+        """Launches branches for the chips on screen, once per turn."""
+        if self.speculated_turn == len(self.history):
+            return
+        self.speculated_turn = len(self.history)
+        summary, window = self.history_manager.window()
+        speculator.launch(self.speculation, chips, window, session_id=self.session_id, summary=summary)
+
+    def end(self, speculator=None):
+        if speculator:
+            speculator.discard(self.speculation)
@@ -0,0 +1,44 @@
+"""
+File: eval_cache.py
+Description: Content-addressed store of finished eval case results.
+Each entry is one small JSON file named after the hash of everything that can
+change the outcome (case, expected outcome, prompt, KB, models, rubric), so an
+edit only invalidates the cases it actually touches; stale files are never
+matched again and can be deleted with the directory at any time.
+"""
+import os
+import json
+import tempfile
+import threading
+
+class EvalCache:
+    def __init__(self, directory=".eval_cache"):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            record = None
+        with self._lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return record
+
+    def put(self, key, record):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so a crashed or parallel run never leaves a half-written entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp, path)
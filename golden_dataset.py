@@ -0,0 +1,208 @@
+"""
+File: golden_dataset.py
+Description: Compiled, indexed golden dataset for the eval suite.
+The golden source (a CSV export plus the inline eval_judge.TEST_CASES) is
+validated and compiled once into a versioned JSONL file with a byte-offset
+index by case id. Loading reads only the header and index; cases are parsed
+on demand (get) or streamed line by line (iteration), so the suite can grow
+far beyond what fits comfortably in memory. The compiled file is rebuilt only
+when the source file or the inline cases change.
+
+Usage: python golden_dataset.py compile [--source golden_dataset.csv] [--out golden_dataset.jsonl]
+"""
+import os
+import io
+import csv
+import json
+import hashlib
+import zipfile
+import argparse
+import tempfile
+
+FORMAT_VERSION = 1
+DEFAULT_SOURCE = "golden_dataset.csv"
+DEFAULT_OUTPUT = "golden_dataset.jsonl"
+HISTORY_ROLES = {"user", "assistant"}
+
+class DatasetError(ValueError):
+    pass
+
+def validate(record):
+    """Raises DatasetError unless record matches {id: str, input: str, history: [{role, content}], expected: str|None}."""
+    case_id = record.get("id")
+    if not isinstance(case_id, str) or not case_id.strip():
+        raise DatasetError(f"case has no id: {record!r}")
+    if not isinstance(record.get("input"), str) or not record["input"].strip():
+        raise DatasetError(f"{case_id}: 'input' must be a non-empty string")
+    history = record.get("history", [])
+    if not isinstance(history, list):
+        raise DatasetError(f"{case_id}: 'history' must be a list")
+    for i, msg in enumerate(history):
+        if not isinstance(msg, dict) or msg.get("role") not in HISTORY_ROLES or not isinstance(msg.get("content"), str):
+            raise DatasetError(f"{case_id}: history[{i}] must be {{'role': 'user'|'assistant', 'content': str}}")
+    expected = record.get("expected")
+    if expected is not None and not isinstance(expected, str):
+        raise DatasetError(f"{case_id}: 'expected' must be a string or null")
+    unknown = set(record) - {"id", "input", "history", "expected"}
+    if unknown:
+        raise DatasetError(f"{case_id}: unknown fields {sorted(unknown)}")
+    return {"id": case_id, "input": record["input"], "history": history, "expected": expected}
+
+# --- SOURCE ---
+def read_source(path):
+    """
+    Yields rows from a CSV export with `expected_outcome` and either `id` or
+    `user_input` (optionally `history` as JSON). Spreadsheet bundles saved
+    under a .csv name are rejected with an explicit error instead of being
+    half-parsed.
+    """
+    if zipfile.is_zipfile(path):
+        raise DatasetError(f"{path} is a zipped spreadsheet bundle (e.g. Apple Numbers), not CSV. "
+                           f"Re-export it as CSV with columns id or user_input, and expected_outcome.")
+    # utf-8-sig handles special characters from copy-pastes
+    with open(path, mode="r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        columns = set(reader.fieldnames or [])
+        if "expected_outcome" not in columns or not columns & {"id", "user_input"}:
+            raise DatasetError(f"{path}: expected columns 'expected_outcome' and 'id' or 'user_input', "
+                               f"got {sorted(columns)}")
+        for line, row in enumerate(reader, start=2):
+            try:
+                history = json.loads(row["history"]) if row.get("history") else []
+            except ValueError as e:
+                raise DatasetError(f"{path}:{line}: history is not valid JSON ({e})")
+            yield {"id": (row.get("id") or "").strip(), "input": (row.get("user_input") or "").strip(),
+                   "history": history, "expected": (row.get("expected_outcome") or "").strip() or None}
+
+def _normalize(text):
+    return " ".join(text.split()).lower()
+
+def merge(cases, rows):
+    """Attaches source rows to inline cases by id, then by input text; unmatched rows become new cases."""
+    merged = {case["id"]: {"id": case["id"], "input": case["input"], "history": case.get("history", []),
+                           "expected": case.get("expected")} for case in cases}
+    by_input = {_normalize(case["input"]): case_id for case_id, case in merged.items()}
+    added = 0
+    for row in rows:
+        case_id = row["id"] or by_input.get(_normalize(row["input"]))
+        if case_id in merged:
+            merged[case_id]["expected"] = row["expected"] or merged[case_id]["expected"]
+            if row["input"]:
+                merged[case_id]["input"] = row["input"]
+            if row["history"]:
+                merged[case_id]["history"] = row["history"]
+            continue
+        added += 1
+        case_id = case_id or f"G{added}"
+        merged[case_id] = dict(row, id=case_id)
+    return merged.values()
+
+# --- COMPILED FORMAT ---
+def _fingerprint(cases, source):
+    digest = hashlib.sha256(json.dumps(list(cases), sort_keys=True).encode())
+    if source and os.path.exists(source):
+        stat = os.stat(source)
+        digest.update(f"{os.path.abspath(source)}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+    return digest.hexdigest()[:16]
+
+def compile_dataset(cases, source=DEFAULT_SOURCE, out=DEFAULT_OUTPUT, strict=False):
+    """
+    Writes `out` (JSONL: a header line, then one validated case per line) and
+    `out`.idx (case id -> byte offset). A broken source raises when strict,
+    otherwise the inline cases are compiled on their own and the reason is
+    recorded in the header as `source_error`.
+    """
+    source_error = None
+    rows = []
+    if source and os.path.exists(source):
+        try:
+            rows = list(read_source(source))
+        except (DatasetError, OSError, csv.Error, UnicodeDecodeError) as e:
+            if strict:
+                raise
+            source_error = str(e)
+    records = [validate(record) for record in merge(cases, rows)]
+
+    header = {"format": FORMAT_VERSION, "fingerprint": _fingerprint(cases, source), "source": source,
+              "source_error": source_error, "cases": len(records),
+              "with_expected": sum(1 for r in records if r["expected"])}
+    buffer = io.BytesIO()
+    buffer.write((json.dumps(header) + "\n").encode())
+    index = {}
+    for record in records:
+        if record["id"] in index:
+            raise DatasetError(f"duplicate case id {record['id']}")
+        index[record["id"]] = buffer.tell()
+        buffer.write((json.dumps(record, ensure_ascii=False) + "\n").encode())
+
+    _write_atomic(out, buffer.getvalue())
+    _write_atomic(out + ".idx", json.dumps({"header": header, "offsets": index}).encode())
+    return header
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class CompiledDataset:
+    """Read-only view of a compiled dataset; only the index is held in memory."""
+
+    def __init__(self, path=DEFAULT_OUTPUT):
+        self.path = path
+        with open(path + ".idx") as f:
+            index = json.load(f)
+        self.header = index["header"]
+        self._offsets = index["offsets"]
+        if self.header.get("format") != FORMAT_VERSION:
+            raise DatasetError(f"{path}: format {self.header.get('format')} != {FORMAT_VERSION}; recompile it")
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, case_id):
+        return case_id in self._offsets
+
+    def ids(self):
+        return list(self._offsets)
+
+    def get(self, case_id):
+        with open(self.path, "rb") as f:
+            f.seek(self._offsets[case_id])
+            return json.loads(f.readline())
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            f.readline()
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def load(cases, source=DEFAULT_SOURCE, path=DEFAULT_OUTPUT):
+    """The compiled dataset at `path`, recompiled first if it is missing or stale."""
+    try:
+        dataset = CompiledDataset(path)
+        if dataset.header.get("fingerprint") == _fingerprint(cases, source):
+            return dataset
+    except (OSError, ValueError, KeyError):
+        pass
+    compile_dataset(cases, source, path)
+    return CompiledDataset(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile the golden dataset for the eval suite.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("compile", help="Validate the golden source and write the compiled JSONL and index.")
+    build.add_argument("--source", default=DEFAULT_SOURCE)
+    build.add_argument("--out", default=DEFAULT_OUTPUT)
+    args = parser.parse_args(argv)
+
+    from eval_judge import TEST_CASES
+    try:
+        header = compile_dataset(TEST_CASES, args.source, args.out, strict=True)
+    except DatasetError as e:
+        raise SystemExit(f"❌ {e}")
+    print(f"✅ {args.out}: {header['cases']} cases, {header['with_expected']} with expected outcomes")
+
+if __name__ == "__main__":
+    main()
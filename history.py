@@ -0,0 +1,127 @@
+"""
+File: history.py
+Description: Token-budgeted conversation window with a rolling summary.
+HistoryManager keeps the last N turns verbatim and folds anything older into a
+compact running summary, so the history sent to the model stays roughly flat
+no matter how long the session runs.
+"""
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from text_utils import estimate_tokens
+
+# Shared by every session: folding is cheap and must never block the chat turn
+_fold_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-fold")
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+def _text(msg):
+    return msg.get("text", msg.get("content", ""))
+
+def extractive_summary(previous, messages, token_budget=250, line_chars=140):
+    """Local summarizer: one line per folded message (its first sentence), oldest lines dropped past the budget."""
+    lines = previous.splitlines() if previous else []
+    for msg in messages:
+        speaker = "User" if msg["role"] == "user" else "Agent"
+        first = _SENTENCE_RE.split(_text(msg).strip(), maxsplit=1)[0]
+        if len(first) > line_chars:
+            first = first[:line_chars - 3].rstrip() + "..."
+        lines.append(f"{speaker}: {first}")
+    while lines and estimate_tokens("\n".join(lines)) > token_budget:
+        lines.pop(0)
+    return "\n".join(lines)
+
+class HistoryManager:
+    """
+    append() is O(1) amortised: every message carries its token estimate, the
+    window keeps a running total, and each message is evicted at most once.
+    Evicted messages are folded into `summary` on a background pool; until a
+    fold lands they are still returned by window(), so nothing drops out of
+    context in between.
+    """
+
+    def __init__(self, max_turns=6, token_budget=1200, summarizer=None, background=True):
+        self.max_messages = max_turns * 2
+        self.token_budget = token_budget
+        self.summary = ""
+        # Number of leading messages already folded into `summary`
+        self.folded = 0
+        self._summarizer = summarizer or extractive_summary
+        self._background = background
+        self._window = deque()      # (message, tokens)
+        self._window_tokens = 0
+        self._pending = []
+        self._folding = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_messages(cls, messages, **kwargs):
+        manager = cls(**kwargs)
+        for msg in messages:
+            manager.append(msg)
+        return manager
+
+    @classmethod
+    def from_state(cls, messages, summary="", folded=0, **kwargs):
+        """Rebuilds a saved manager: messages already in `summary` are skipped instead of summarised again."""
+        manager = cls(**kwargs)
+        manager.summary = summary
+        manager.folded = folded
+        for msg in messages[folded:]:
+            manager.append(msg)
+        return manager
+
+    def append(self, msg):
+        tokens = estimate_tokens(_text(msg))
+        with self._lock:
+            self._window.append((msg, tokens))
+            self._window_tokens += tokens
+            evicted = False
+            # Always keep the newest exchange verbatim, even if it alone exceeds the budget
+            while len(self._window) > 2 and (len(self._window) > self.max_messages
+                                             or self._window_tokens > self.token_budget):
+                old, old_tokens = self._window.popleft()
+                self._window_tokens -= old_tokens
+                self._pending.append(old)
+                evicted = True
+            start_fold = evicted and not self._folding
+            if start_fold:
+                self._folding = True
+        if start_fold:
+            if self._background:
+                _fold_pool.submit(self._drain)
+            else:
+                self._drain()
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                batch, summary = self._pending[:], self.summary
+                if not batch:
+                    self._folding = False
+                    return
+            try:
+                summary = self._summarizer(summary, batch)
+            except Exception:
+                summary = extractive_summary(summary, batch)
+            with self._lock:
+                self.summary = summary
+                self.folded += len(batch)
+                del self._pending[:len(batch)]
+
+    def window(self):
+        """(summary, messages) to send: the running summary plus unfolded and recent messages."""
+        with self._lock:
+            return self.summary, self._pending + [msg for msg, _ in self._window]
+
+    def state(self):
+        """(summary, folded) for persisting; pass both back to from_state()."""
+        with self._lock:
+            return self.summary, self.folded
+
+    def window_tokens(self):
+        with self._lock:
+            return (estimate_tokens(self.summary) + self._window_tokens
+                    + sum(estimate_tokens(_text(m)) for m in self._pending))
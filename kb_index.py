@@ -0,0 +1,177 @@
+"""
+File: kb_index.py
+Description: In-memory BM25 index over the ## sections of knowledge_base.txt.
+The file is parsed once and re-parsed only when its mtime or size changes, so a
+fact lookup costs a handful of dictionary reads instead of a disk read.
+Policy bullets (an upper-case "LABEL:" bullet in a "... POLICIES" section, or
+a "... POLICY:" bullet anywhere) are rules rather than facts, so every lookup returns them whatever the topic.
+"""
+import os
+import re
+import math
+import hashlib
+import threading
+from collections import Counter, defaultdict
+
+from text_utils import tokenize, estimate_tokens
+
+_RULE_LABEL_RE = re.compile(r"^[*-] ([A-Z][A-Z &]*):")
+
+def _is_policy(title, bullet):
+    label = _RULE_LABEL_RE.match(bullet)
+    return bool(label) and ("POLICIES" in title.upper() or label.group(1).endswith("POLICY"))
+
+class KnowledgeBaseIndex:
+    def __init__(self, path="knowledge_base.txt", k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.version = None
+        self._stamp = None
+        self._lock = threading.Lock()
+        self._text = ""
+        self._sections = []   # [(title, [bullet_id, ...])]
+        self._bullets = []    # [(section_idx, text)]
+        self._postings = {}   # term -> [(bullet_id, tf)]
+        self._norms = []      # per-bullet BM25 length normalisation, precomputed at build
+        self._policies = set()      # bullet ids returned by every lookup
+        self._policy_lines = []     # those bullets under their section headers, in document order
+
+    # --- LOADING ---
+    def _ensure_fresh(self):
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            with open(self.path, "r") as f:
+                self._build(f.read())
+            self._stamp = stamp
+
+    def _build(self, text):
+        sections, bullets = [], []
+        for line in text.splitlines():
+            stripped = line.strip()
+            if stripped.startswith("## "):
+                sections.append((stripped[3:].strip(), []))
+            elif stripped.startswith(("* ", "- ")) and sections:
+                sections[-1][1].append(len(bullets))
+                bullets.append((len(sections) - 1, stripped))
+            elif stripped and sections and sections[-1][1]:
+                # Wrapped continuation of the previous bullet
+                section_idx, previous = bullets[-1]
+                bullets[-1] = (section_idx, previous + " " + stripped)
+
+        postings = defaultdict(list)
+        lengths = []
+        for bullet_id, (section_idx, bullet) in enumerate(bullets):
+            terms = tokenize(sections[section_idx][0] + " " + bullet)
+            lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings[term].append((bullet_id, tf))
+
+        self._text = text
+        self._sections = sections
+        self._bullets = bullets
+        self._postings = dict(postings)
+        avg_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+        self._norms = [self.k1 * (1 - self.b + self.b * length / avg_length) for length in lengths]
+        self._policies, self._policy_lines = set(), []
+        for bullet_id, (section_idx, bullet) in enumerate(bullets):
+            if _is_policy(sections[section_idx][0], bullet):
+                header = f"## {sections[section_idx][0]}"
+                if header not in self._policy_lines:
+                    self._policy_lines.append(header)
+                self._policies.add(bullet_id)
+                self._policy_lines.append(bullet)
+        self.version = hashlib.sha256(text.encode()).hexdigest()[:16]
+
+    # --- QUERYING ---
+    def _score_bullets(self, terms):
+        scores = defaultdict(float)
+        norms = self._norms
+        n = len(self._bullets)
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            weight = idf * (self.k1 + 1)
+            for bullet_id, tf in postings:
+                scores[bullet_id] += weight * tf / (tf + norms[bullet_id])
+        return scores
+
+    def search(self, query, k=3):
+        """Top-k sections as [(score, section_idx, {bullet_id: score})], best first."""
+        self._ensure_fresh()
+        by_section = defaultdict(dict)
+        for bullet_id, score in self._score_bullets(tokenize(query)).items():
+            by_section[self._bullets[bullet_id][0]][bullet_id] = score
+        ranked = []
+        for section_idx, hits in by_section.items():
+            # A section ranks by its three strongest bullets so long sections do not win on volume
+            ranked.append((sum(sorted(hits.values(), reverse=True)[:3]), section_idx, hits))
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+        return ranked[:k]
+
+    def lookup(self, topic, k=3, token_budget=600):
+        """Relevant sections rendered as markdown, trimmed to roughly token_budget tokens."""
+        return self.retrieve(topic, k, token_budget)[0]
+
+    def retrieve(self, topic, k=3, token_budget=600):
+        """
+        Like lookup(), but also returns a 0-1 confidence: the share of distinct
+        query terms that appear in the returned facts (headers included, the
+        always-present policies not).
+        """
+        results = self.search(topic or "", k)
+        if not results:
+            # No term overlap: fall back to the head of the KB rather than nothing
+            results = [(0.0, idx, {}) for idx in range(min(k, len(self._sections)))]
+
+        policy_lines, policy_ids = self._policy_lines, self._policies
+        lines, used = [], sum(estimate_tokens(line) for line in policy_lines)
+        for _score, section_idx, hits in results:
+            title, bullet_ids = self._sections[section_idx]
+            bullet_ids = [b for b in bullet_ids if b not in policy_ids]
+            hits = {b: score for b, score in hits.items() if b not in policy_ids}
+            if not bullet_ids:
+                continue
+            header = f"## {title}"
+            texts = [self._bullets[b][1] for b in bullet_ids]
+            section_cost = estimate_tokens(header) + sum(estimate_tokens(t) for t in texts)
+            if used + section_cost <= token_budget:
+                chosen = bullet_ids
+            else:
+                # Keep the best-matching bullets of an oversized section, in document order
+                chosen, cost = [], estimate_tokens(header)
+                for bullet_id in sorted(hits, key=hits.get, reverse=True):
+                    bullet_cost = estimate_tokens(self._bullets[bullet_id][1])
+                    if used + cost + bullet_cost > token_budget:
+                        break
+                    chosen.append(bullet_id)
+                    cost += bullet_cost
+                chosen.sort()
+                if not chosen:
+                    break
+            lines.append(header)
+            lines.extend(self._bullets[b][1] for b in chosen)
+            used += estimate_tokens(header) + sum(estimate_tokens(self._bullets[b][1]) for b in chosen)
+            if used >= token_budget:
+                break
+        facts = "\n".join(lines)
+        text = "\n".join(policy_lines + lines)
+        query_terms = set(tokenize(topic or ""))
+        if not query_terms:
+            return text, 0.0
+        return text, len(query_terms & set(tokenize(facts))) / len(query_terms)
+
+    def current_version(self):
+        self._ensure_fresh()
+        return self.version
+
+    def full_text(self):
+        self._ensure_fresh()
+        return self._text
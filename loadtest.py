@@ -0,0 +1,214 @@
+"""
+File: loadtest.py
+Description: Multi-session load test for the chat turn path.
+Simulates N concurrent visitors, each replaying multi-turn scripts built from
+eval_judge.TEST_CASES through chat_session.ChatSession.reply (the code path
+behind app.process_user_input), against mock_gemini.FakeClient.
+Prints a JSON report (sessions/sec, turn latency percentiles, memory per
+session) so runs can be diffed between commits. With --speculate, chips are
+pre-generated as in the app and visitors click one with --chip-rate; the
+report then includes the speculator's hit rate and wasted calls.
+Usage: python loadtest.py [--users 50] [--sessions 200] [--speculate] [--out result.json] [--baseline old.json]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+import tracemalloc
+
+import logic
+import mock_gemini
+from chat_session import ChatSession
+from eval_judge import TEST_CASES
+from speculation import Speculator
+
+def build_scripts(turns_per_script=4):
+    """
+    History cases (M1-M7) replay their earlier user turns and then the test input.
+    Single-turn cases are chained `turns_per_script` at a time into synthetic sessions.
+    """
+    scripts = []
+    singles = []
+    for case in TEST_CASES:
+        if case.get("history"):
+            scripts.append([m["content"] for m in case["history"] if m["role"] == "user"] + [case["input"]])
+        else:
+            singles.append(case["input"])
+    for i in range(0, len(singles), turns_per_script):
+        scripts.append(singles[i:i + turns_per_script])
+    return scripts
+
+def _percentiles(samples, scale=1000.0):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    pick = lambda pct: ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+    return {"p50": round(pick(50) * scale, 2), "p95": round(pick(95) * scale, 2),
+            "p99": round(pick(99) * scale, 2), "max": round(ordered[-1] * scale, 2)}
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+class LoadTest:
+    def __init__(self, scripts, sessions, users, think_time=0.0, seed=0, speculator=None, chip_rate=0.0):
+        self.scripts = scripts
+        self.sessions = sessions
+        self.users = users
+        self.think_time = think_time
+        self.speculator = speculator
+        self.chip_rate = chip_rate
+        self.turn_latencies = []
+        self.first_token_latencies = []
+        self.errors = 0
+        self.turns = 0
+        self.finished = []
+        self._next = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _claim(self):
+        with self._lock:
+            if self._next >= self.sessions:
+                return None
+            index = self._next
+            self._next += 1
+            return self.scripts[index % len(self.scripts)]
+
+    def _run_session(self, script):
+        session = ChatSession()
+        latencies, first_tokens, errors = [], [], 0
+        for user_text in script:
+            if session.suggestions and self._rng.random() < self.chip_rate:
+                user_text = self._rng.choice(session.suggestions)
+            started = time.perf_counter()
+            first = []
+            reply = session.reply(user_text, speculator=self.speculator,
+                                  on_delta=lambda shown: first or first.append(time.perf_counter()))
+            latencies.append(time.perf_counter() - started)
+            if first:
+                first_tokens.append(first[0] - started)
+            if reply == logic.ERROR_REPLY:
+                errors += 1
+            if self.speculator:
+                session.speculate(self.speculator, session.suggestions)
+            if self.think_time:
+                time.sleep(self._rng.uniform(0, 2 * self.think_time))
+        session.end(self.speculator)
+        with self._lock:
+            self.turn_latencies.extend(latencies)
+            self.first_token_latencies.extend(first_tokens)
+            self.errors += errors
+            self.turns += len(script)
+            # Kept alive until the end so their footprint shows up in the memory measurement
+            self.finished.append(session)
+
+    def _worker(self):
+        while True:
+            script = self._claim()
+            if script is None:
+                return
+            self._run_session(script)
+
+    def run(self):
+        threads = [threading.Thread(target=self._worker, name=f"user-{i}", daemon=True) for i in range(self.users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+def run(args):
+    logic.RESPONSE_CACHE = args.response_cache
+    logic.client = mock_gemini.FakeClient(
+        first_token_latency=args.latency,
+        chunk_latency=args.chunk_latency,
+        latency_sigma=args.latency_sigma,
+        function_call_rate=args.function_call_rate,
+        error_rate=args.error_rate,
+        tail_rate=args.tail_rate,
+        tail_latency=args.tail_latency,
+        seed=args.seed,
+    )
+    scripts = build_scripts(args.turns_per_script)
+    speculator = Speculator(logic.get_gemini_response, max_workers=args.speculative_workers) if args.speculate else None
+    test = LoadTest(scripts, args.sessions, args.users, args.think_time, args.seed, speculator, args.chip_rate)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    elapsed = test.run()
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "sessions": len(test.finished),
+        "turns": test.turns,
+        "errors": test.errors,
+        "error_rate": round(test.errors / test.turns, 4) if test.turns else 0.0,
+        "upstream_calls": logic.client.calls,
+        "duration_s": round(elapsed, 3),
+        "sessions_per_sec": round(len(test.finished) / elapsed, 3),
+        "turns_per_sec": round(test.turns / elapsed, 3),
+        "turn_latency_ms": _percentiles(test.turn_latencies),
+        "first_token_ms": _percentiles(test.first_token_latencies),
+        "memory_per_session_kb": round(retained / 1024 / max(1, len(test.finished)), 2),
+        "speculation": speculator.stats() if speculator else None,
+    }
+
+def compare(result, baseline):
+    """Relative change of the headline metrics against an earlier result file."""
+    rows = [("sessions_per_sec", result["sessions_per_sec"], baseline["sessions_per_sec"]),
+            ("memory_per_session_kb", result["memory_per_session_kb"], baseline["memory_per_session_kb"]),
+            ("error_rate", result["error_rate"], baseline["error_rate"])]
+    for pct in ("p50", "p95", "p99"):
+        rows.append((f"turn_latency_ms.{pct}", result["turn_latency_ms"][pct], baseline["turn_latency_ms"][pct]))
+    for name, new, old in rows:
+        change = f"{(new - old) / old:+.1%}" if old else "n/a"
+        print(f"{name:<24} {old:>10} -> {new:<10} ({change})", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Concurrent simulated visitors.")
+    parser.add_argument("--sessions", type=int, default=200, help="Total sessions to replay across all users.")
+    parser.add_argument("--turns-per-script", type=int, default=4)
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean seconds between a user's turns.")
+    parser.add_argument("--latency", type=float, default=0.3, help="Median first-token latency of the mock.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Lognormal spread of that latency.")
+    parser.add_argument("--chunk-latency", type=float, default=0.01)
+    parser.add_argument("--function-call-rate", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tail-rate", type=float, default=0.0)
+    parser.add_argument("--tail-latency", type=float, default=2.0)
+    parser.add_argument("--response-cache", action="store_true", help="Leave the response cache on.")
+    parser.add_argument("--speculate", action="store_true", help="Pre-generate replies for the chips on screen.")
+    parser.add_argument("--speculative-workers", type=int, default=4)
+    parser.add_argument("--chip-rate", type=float, default=0.0,
+                        help="Probability that a visitor clicks a displayed chip instead of typing the next line.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Also write the JSON result to this file.")
+    parser.add_argument("--baseline", help="Earlier JSON result to compare against.")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
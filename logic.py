@@ -4,12 +4,26 @@ Description: Final production-ready logic for Workspace Sales Agent.
 Implementation: JSON Mode with Binary State Enforcement and M3 Fix.
 """
 import os
-import json
 import re
+import time
+import asyncio
+import hashlib
+import contextvars
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 
+from kb_index import KnowledgeBaseIndex
+from prompt_cache import PrefixCache, SessionContentsRegistry
+from response_cache import ResponseCache
+import admission
+import cascade
+import cassette
+import intent_router
+import structured
+from resilience import RetryPolicy, LatencyTracker, CallStats, LoopThread, call_with_retries, is_retryable
+from tracing import tracer
+
 load_dotenv()
 api_key = os.getenv("GOOGLE_API_KEY")
 model_id = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-001")
@@ -17,11 +31,16 @@ model_id = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-001")
 client = None
 if api_key:
     client = genai.Client(api_key=api_key)
+# Replayed calls never reach the scheduler, so they cost no quota
+client = cassette.from_env(admission.from_env(client))
+
+kb_index = KnowledgeBaseIndex("knowledge_base.txt")
+KB_TOP_K = int(os.getenv("KB_TOP_K", "3"))
+KB_TOKEN_BUDGET = int(os.getenv("KB_TOKEN_BUDGET", "600"))
 
-def get_workspace_fact() -> str:
+def get_workspace_fact(topic: str = "") -> str:
     try:
-        with open("knowledge_base.txt", "r") as f:
-            return f.read()
+        return kb_index.lookup(topic, k=KB_TOP_K, token_budget=KB_TOKEN_BUDGET)
     except Exception as e:
         return "System Error: Knowledge base unavailable."
 
@@ -39,19 +58,7 @@ workspace_tool = types.Tool(
     ]
 )
 
-def get_gemini_response(user_input, chat_history):
-    try:
-        if not client:
-            return "Error: API Key not found.", "0", []
-
-        formatted_contents = []
-        for msg in chat_history:
-            role = "model" if msg["role"] == "bot" else "user"
-            formatted_contents.append(
-                types.Content(role=role, parts=[types.Part.from_text(text=msg.get("text", msg.get("content", "")))] )
-            )
-
-        system_prompt = """
+SYSTEM_PROMPT = """
         You are an expert Google Workspace Sales Agent. 
         Target: Business Standard ($12/user/month) for SMBs on Business Starter.
 
@@ -69,36 +76,617 @@ def get_gemini_response(user_input, chat_history):
         }
         """
 
-        final_contents = [types.Content(role="user", parts=[types.Part.from_text(text=system_prompt)])] + formatted_contents
-        final_contents.append(types.Content(role="user", parts=[types.Part.from_text(text=user_input)]))
+# Bump-free versioning: any edit to the prompt text changes the cache keys derived from it
+SYSTEM_PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode()).hexdigest()[:12]
+
+ERROR_REPLY = ("I'm having a bit of trouble with that. Could you try again?", "0", [])
+
+# Hard-coded Emergency Brake for Hostility/Dealbreakers (Fixes M3)
+HOSTILE_TRIGGERS = ["human", "dealbreaker", "stop pitching", "complain", "bill", "cancel"]
+
+def _to_content(msg):
+    role = "model" if msg["role"] == "bot" else "user"
+    return types.Content(role=role, parts=[types.Part.from_text(text=msg.get("text", msg.get("content", "")))] )
 
-        config = types.GenerateContentConfig(
-            tools=[workspace_tool],
+# --- PREFIX CACHING ---
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "0") == "1"
+prefix_cache = PrefixCache(ttl_seconds=int(os.getenv("PROMPT_CACHE_TTL", "3600")))
+session_contents = SessionContentsRegistry(_to_content)
+
+def _build_contents(user_input, chat_history, session_id=None, cached=False, intent=None, facts=None, summary=None):
+    if session_id is not None:
+        formatted_contents = session_contents.contents_for(session_id, chat_history)
+    else:
+        formatted_contents = [_to_content(msg) for msg in chat_history]
+    if summary:
+        formatted_contents.insert(0, types.Content(role="user", parts=[
+            types.Part.from_text(text=f"[SUMMARY OF EARLIER CONVERSATION]\n{summary}")]))
+
+    # With a cached prefix the system prompt already lives server-side as the system instruction
+    final_contents = formatted_contents if cached else [
+        types.Content(role="user", parts=[types.Part.from_text(text=SYSTEM_PROMPT)])] + formatted_contents
+    user_parts = [types.Part.from_text(text=user_input)]
+    hint = intent_router.prompt_hint(intent) if intent else None
+    if hint:
+        user_parts.insert(0, types.Part.from_text(text=hint))
+    if facts:
+        user_parts.insert(0, types.Part.from_text(text=f"[KNOWLEDGE BASE EXCERPTS]\n{facts}"))
+    final_contents.append(types.Content(role="user", parts=user_parts))
+    return final_contents
+
+def _generation_config(cache_name=None, tools=True):
+    if cache_name:
+        # Tools, when offered, are part of the cached context and must not be resent alongside it
+        return types.GenerateContentConfig(
+            cached_content=cache_name,
             temperature=0.1,
-            response_mime_type="application/json"
+            response_mime_type="application/json",
+            response_schema=None if tools else structured.REPLY_SCHEMA
         )
+    return types.GenerateContentConfig(
+        tools=[workspace_tool] if tools else None,
+        temperature=0.1,
+        response_mime_type="application/json",
+        # Gemini rejects a response schema alongside function declarations; tool turns rely on the repair parser
+        response_schema=None if tools else structured.REPLY_SCHEMA
+    )
 
-        response = client.models.generate_content(model=model_id, contents=final_contents, config=config)
+def _prepare(user_input, chat_history, session_id=None, intent=None, facts=None, summary=None, cacheable=True):
+    cache_name = None
+    # Inline mode caches the prefix without the tool, so a low-confidence turn that needs the tool
+    # sends the prefix inline; the cached prefix also belongs to model_id, so fast-tier turns do too
+    inline = FACT_MODE == "inline"
+    if PROMPT_CACHE and cacheable and (facts or not inline):
+        cache_name = prefix_cache.handle(client, model_id, SYSTEM_PROMPT, kb_index.full_text(),
+                                         None if inline else [workspace_tool], fact_mode=FACT_MODE)
+        tracer.annotate(prompt_cache=bool(cache_name))
+    contents = _build_contents(user_input, chat_history, session_id, cached=bool(cache_name), intent=intent,
+                               facts=facts, summary=summary)
+    # Inline facts make the tool redundant; without a declared tool the turn is a single round trip
+    return contents, _generation_config(cache_name, tools=not facts)
 
-        if response.candidates and response.candidates[0].content.parts[0].function_call:
-            fact_data = get_workspace_fact()
-            final_contents.append(response.candidates[0].content)
-            final_contents.append(types.Content(role="user", parts=[
-                types.Part.from_function_response(name="get_workspace_fact", response={"result": fact_data})]))
-            response = client.models.generate_content(model=model_id, contents=final_contents, config=config)
+# --- FACT MODE ---
+# "tool": the model asks for get_workspace_fact (two calls on factual turns).
+# "inline": relevant KB excerpts ride along with the user turn; the tool is only
+# offered when retrieval confidence is below FACT_CONFIDENCE.
+FACT_MODE = os.getenv("FACT_MODE", "tool")
+FACT_CONFIDENCE = float(os.getenv("FACT_CONFIDENCE", "0.3"))
 
-        data = json.loads(response.text)
-        reply_text = data.get("text", "").strip()
-        score = data.get("score", "50")
-        suggestions = data.get("chips", [])
+_call_stats = contextvars.ContextVar("call_stats", default=None)
 
-        # Hard-coded Emergency Brake for Hostility/Dealbreakers (Fixes M3)
-        hostile_triggers = ["human", "dealbreaker", "stop pitching", "complain", "bill", "cancel"]
-        if any(x in user_input.lower() for x in hostile_triggers):
-            suggestions = []
-            score = "0"
+def last_call_stats():
+    """Stats for the most recent get_gemini_response call in this thread (or asyncio task)."""
+    return dict(_call_stats.get() or {})
 
-        return reply_text, score, suggestions
+def _new_call_stats():
+    stats = {"model_calls": 0, "retries": 0, "hedges": 0, "fact_mode": FACT_MODE, "fact_confidence": None,
+             "inline_facts": False, "response_cache_hit": False, "intent": None, "output_repairs": [],
+             "tier": None, "escalated": False, "cascade": [], "tier_ms": {}, "usage": {}, "error": None}
+    _call_stats.set(stats)
+    return stats
 
-    except Exception as e:
-        return f"I'm having a bit of trouble with that. Could you try again?", "0", []
\ No newline at end of file
+def _inline_facts(user_input, stats):
+    if FACT_MODE != "inline":
+        return None
+    try:
+        facts, confidence = kb_index.retrieve(user_input, k=KB_TOP_K, token_budget=KB_TOKEN_BUDGET)
+    except OSError:
+        return None
+    stats["fact_confidence"] = round(confidence, 3)
+    if confidence < FACT_CONFIDENCE or not facts:
+        return None
+    stats["inline_facts"] = True
+    return facts
+
+def _function_call(response):
+    if response.candidates and response.candidates[0].content.parts[0].function_call:
+        return response.candidates[0].content.parts[0].function_call
+    return None
+
+def _append_tool_result(final_contents, model_content):
+    call = next((p.function_call for p in model_content.parts if p.function_call), None)
+    topic = (call.args or {}).get("topic", "") if call else ""
+    with tracer.span("kb_lookup"):
+        fact_data = get_workspace_fact(topic)
+    final_contents.append(model_content)
+    final_contents.append(types.Content(role="user", parts=[
+        types.Part.from_function_response(name="get_workspace_fact", response={"result": fact_data})]))
+
+# --- INTENT ROUTING ---
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "1") == "1"
+ROUTER_EXIT_THRESHOLD = float(os.getenv("ROUTER_EXIT_THRESHOLD", "0.9"))
+
+EXIT_REPLY = ("Understood. I'll pass our conversation to a Workspace specialist who can pick this up with you directly. "
+              "Thanks for your time today.", "0", [])
+# Which turns are short-circuited, and what they get, for cache keys
+ROUTER_VERSION = hashlib.sha256(
+    f"{intent_router.VERSION}|{ROUTER_EXIT_THRESHOLD}|{EXIT_REPLY!r}".encode()).hexdigest()[:12]
+
+def _route(user_input):
+    if not INTENT_ROUTER:
+        return None
+    return intent_router.classify(user_input)
+
+def _short_circuit(intent, user_input):
+    # Confident EXIT turns get the handoff template without paying for a model call,
+    # unless the turn also asks about the offer ("stop pitching, what does it cost?")
+    if (intent and intent.label == intent_router.EXIT and intent.confidence >= ROUTER_EXIT_THRESHOLD
+            and not intent_router.asks_product_question(user_input)):
+        return EXIT_REPLY
+    return None
+
+# --- MODEL CASCADE ---
+def _tier_model(tier):
+    return cascade.FAST_MODEL if tier == cascade.FAST else model_id
+
+def _route_tier(user_input, intent, stats):
+    decision = cascade.route(user_input, intent) if cascade.ENABLED else cascade.Decision(cascade.STRONG, [])
+    stats["cascade"] = list(decision.reasons)
+    return decision.tier
+
+def _escalate(stats, tier, *reasons):
+    if tier == cascade.FAST:
+        stats["escalated"] = True
+        stats["cascade"].extend(reasons)
+    return cascade.STRONG
+
+def _account(stats, tier, usage, seconds):
+    """Per-tier wall time and (input, output) tokens for the routing log and the cost comparison."""
+    stats["tier_ms"][tier] = round(stats["tier_ms"].get(tier, 0) + seconds * 1000, 3)
+    if usage is not None:
+        tokens = stats["usage"].setdefault(tier, [0, 0])
+        tokens[0] += usage.prompt_token_count or 0
+        tokens[1] += usage.candidates_token_count or 0
+
+def _hostile(user_input):
+    return any(x in user_input.lower() for x in HOSTILE_TRIGGERS)
+
+def _parse_reply(text, stats):
+    # Repairs (fences, truncation, numeric scores...) are applied locally instead of failing the turn
+    with tracer.span("parse"):
+        return structured.parse_reply(text, defects=stats["output_repairs"])
+
+def _finalize(data, user_input):
+    reply_text = data.get("text", "").strip()
+    score = data.get("score", "50")
+    suggestions = data.get("chips", [])
+
+    if _hostile(user_input):
+        suggestions = []
+        score = "0"
+
+    return reply_text, score, suggestions
+
+# --- RESPONSE CACHE ---
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")),
+    ttl_seconds=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    disk_path=os.getenv("RESPONSE_CACHE_PATH") or None,
+)
+
+def _normalize(text):
+    return " ".join(text.split())
+
+def _response_key(user_input, chat_history, intent=None, summary=None):
+    if not RESPONSE_CACHE:
+        return None
+    try:
+        kb_version = kb_index.current_version()
+    except OSError:
+        return None
+    history = [("model" if msg["role"] in ("bot", "assistant", "model") else "user",
+                _normalize(msg.get("text", msg.get("content", "")))) for msg in chat_history]
+    return ResponseCache.key(model=model_id, prompt=SYSTEM_PROMPT_VERSION, kb=kb_version,
+                             history=history, input=_normalize(user_input),
+                             intent=intent.label if intent else None, router=ROUTER_VERSION, fact_mode=FACT_MODE,
+                             summary=_normalize(summary or ""),
+                             cascade=cascade.FAST_MODEL if cascade.ENABLED else None)
+
+def _cache_lookup(user_input, chat_history, intent=None, summary=None):
+    """(key, cached reply or None); key is None when the response cache does not apply."""
+    cache_key = _response_key(user_input, chat_history, intent, summary)
+    return cache_key, response_cache.get(cache_key) if cache_key else None
+
+def _cacheable(data, stats):
+    # A reply rebuilt from truncated JSON (cut-off text, default score, no chips) is fine once, not for every session
+    return (isinstance(data, dict) and bool(str(data.get("text", "")).strip())
+            and "truncated" not in stats["output_repairs"])
+
+# --- ASYNC CLIENT PATH ---
+retry_policy = RetryPolicy(
+    attempts=int(os.getenv("GEMINI_ATTEMPTS", "3")),
+    attempt_timeout=float(os.getenv("GEMINI_TIMEOUT", "30")),
+    base_delay=float(os.getenv("GEMINI_BACKOFF_BASE", "0.5")),
+    max_delay=float(os.getenv("GEMINI_BACKOFF_MAX", "8")),
+    hedge=os.getenv("GEMINI_HEDGE", "0") == "1",
+    hedge_delay=float(os.getenv("GEMINI_HEDGE_DELAY", "2.0")),
+)
+latency_tracker = LatencyTracker()
+_loop = LoopThread()
+
+async def _generate_async(contents, config, stats, tier=cascade.STRONG):
+    call_stats = CallStats()
+    stats["model_calls"] += 1
+    model = _tier_model(tier)
+    started = time.perf_counter()
+    with tracer.span(f"model_call.{stats['model_calls']}") as span:
+        try:
+            response = await call_with_retries(
+                lambda: client.aio.models.generate_content(model=model, contents=contents, config=config),
+                retry_policy, latency_tracker, call_stats)
+        finally:
+            stats["retries"] += call_stats.retries
+            stats["hedges"] += call_stats.hedges
+            span.set(attempts=call_stats.attempts, hedges=call_stats.hedges, tier=tier)
+        tracer.record_usage(response.usage_metadata, span)
+        _account(stats, tier, response.usage_metadata, time.perf_counter() - started)
+        return response
+
+async def _complete_async(final_contents, config, stats, tier, user_input):
+    """The model calls of one turn: the tool round trip plus any cascade escalation."""
+    response = await _generate_async(final_contents, config, stats, tier)
+    if _function_call(response):
+        # The fact lookup reads the KB index (and may reload it from disk)
+        await asyncio.to_thread(_append_tool_result, final_contents, response.candidates[0].content)
+        # Fact lookups need a grounded answer, so the strong tier writes it
+        tier = _escalate(stats, tier, "tool_call")
+        response = await _generate_async(final_contents, config, stats, tier)
+    if tier != cascade.FAST:
+        stats["tier"] = tier
+        return _parse_reply(response.text, stats)
+
+    try:
+        data = _parse_reply(response.text, stats)
+        reasons = cascade.review(data, stats["output_repairs"], response, closing_question=not _hostile(user_input))
+    except structured.StructuredOutputError:
+        reasons = ["unparseable"]
+    if reasons:
+        tier = _escalate(stats, tier, *reasons)
+        return await _complete_async(final_contents, config, stats, tier, user_input)
+    stats["tier"] = tier
+    return data
+
+async def get_gemini_response_async(user_input, chat_history, session_id=None, summary=None):
+    stats = _new_call_stats()
+    with tracer.trace("turn", model=model_id):
+        try:
+            return await _respond_async(user_input, chat_history, session_id, summary, stats)
+        except cassette.CassetteMiss:
+            # A replay that drifted from its recording must fail loudly, not grade as a bad reply
+            raise
+        except Exception as e:
+            stats["error"] = type(e).__name__
+            tracer.annotate(error=stats["error"])
+            return ERROR_REPLY
+        finally:
+            tracer.annotate(**stats)
+
+async def _respond_async(user_input, chat_history, session_id, summary, stats):
+    with tracer.span("route"):
+        intent = _route(user_input)
+    stats["intent"] = intent.label if intent else None
+    routed = _short_circuit(intent, user_input)
+    if routed:
+        return routed
+
+    if not client:
+        stats["error"] = "NoClient"
+        return "Error: API Key not found.", "0", []
+
+    # Cached replies are stored before _finalize so the hostile-trigger override still runs on hits
+    with tracer.span("response_cache"):
+        # The key stats the KB file and the lookup reads SQLite; neither may stall the shared loop
+        cache_key, data = await asyncio.to_thread(_cache_lookup, user_input, chat_history, intent, summary)
+    stats["response_cache_hit"] = data is not None
+    if data is None:
+        with tracer.span("retrieval"):
+            facts = await asyncio.to_thread(_inline_facts, user_input, stats) if FACT_MODE == "inline" else None
+        tier = _route_tier(user_input, intent, stats)
+        cacheable = tier == cascade.STRONG
+        with tracer.span("prompt_build"):
+            if PROMPT_CACHE and cacheable:
+                # Creating the cached context is a blocking API call; keep it off the event loop
+                final_contents, config = await asyncio.to_thread(
+                    _prepare, user_input, chat_history, session_id, intent, facts, summary)
+            else:
+                final_contents, config = _prepare(user_input, chat_history, session_id, intent, facts, summary,
+                                                  cacheable)
+
+        data = await _complete_async(final_contents, config, stats, tier, user_input)
+        if cache_key and _cacheable(data, stats):
+            await asyncio.to_thread(response_cache.put, cache_key, data)
+
+    return _finalize(data, user_input)
+
+async def _with_stats(coro):
+    result = await coro
+    return result, last_call_stats()
+
+def get_gemini_response(user_input, chat_history, session_id=None, summary=None):
+    """Synchronous wrapper: runs get_gemini_response_async on the shared background loop."""
+    result, stats = _loop.run(_with_stats(get_gemini_response_async(user_input, chat_history, session_id, summary)))
+    _call_stats.set(stats)
+    return result
+
+# --- STREAMING ---
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+class JsonTextExtractor:
+    """
+    Incrementally decodes the top-level "text" string of a streamed JSON object.
+    feed() returns the newly displayable characters for each fragment; escape
+    sequences split across fragments are held back until complete.
+    """
+
+    def __init__(self, key="text"):
+        self.key = key
+        self.buffer = []
+        self.text = ""
+        self.done = False
+        self._depth = 0
+        self._in_str = False
+        self._expect_key = False
+        self._capturing = False
+        self._is_key = False
+        self._key_chars = []
+        self._last_key = None
+        self._escape = None
+        self._high_surrogate = None
+
+    def feed(self, fragment):
+        self.buffer.append(fragment)
+        out = []
+        for ch in fragment:
+            if self._in_str:
+                self._string_char(ch, out)
+            elif ch in "{[":
+                self._depth += 1
+                self._expect_key = ch == "{" and self._depth == 1
+            elif ch in "}]":
+                self._depth -= 1
+            elif ch == "," and self._depth == 1:
+                self._expect_key = True
+            elif ch == ":" and self._depth == 1:
+                self._expect_key = False
+            elif ch == '"':
+                self._in_str = True
+                self._is_key = self._depth == 1 and self._expect_key
+                self._capturing = (self._depth == 1 and not self._is_key
+                                   and self._last_key == self.key and not self.done)
+                self._key_chars = []
+        delta = "".join(out)
+        self.text += delta
+        return delta
+
+    def _string_char(self, ch, out):
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape[0] == "u":
+                if len(self._escape) < 5:
+                    return
+                self._emit(chr(int(self._escape[1:], 16)), out)
+            else:
+                self._emit(_ESCAPES.get(ch, ch), out)
+            self._escape = None
+        elif ch == "\\":
+            self._escape = ""
+        elif ch == '"':
+            self._in_str = False
+            if self._is_key:
+                self._last_key = "".join(self._key_chars)
+            elif self._capturing:
+                self._capturing = False
+                self.done = True
+        else:
+            self._emit(ch, out)
+
+    def _emit(self, ch, out):
+        if self._is_key:
+            self._key_chars.append(ch)
+            return
+        if not self._capturing:
+            return
+        code = ord(ch)
+        if 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+            return
+        if 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            ch = chr(0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00))
+        self._high_surrogate = None
+        out.append(ch)
+
+    def raw(self):
+        return "".join(self.buffer)
+
+_DONE = object()
+
+class StreamedReply:
+    """
+    Iterating yields displayable deltas of the reply text as tokens arrive.
+    Once exhausted, `result` holds the same (text, score, chips) tuple that
+    get_gemini_response returns; `score` and `chips` resolve when the JSON closes.
+    """
+
+    def __init__(self, user_input, chat_history, session_id=None, summary=None, trace_attrs=None):
+        self.user_input = user_input
+        self.chat_history = chat_history
+        self.session_id = session_id
+        self.summary = summary
+        # Extra attributes for this turn's trace record (e.g. how speculation went)
+        self.trace_attrs = dict(trace_attrs or {})
+        self.result = None
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.stats = None
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    def __iter__(self):
+        # The trace is made current only while a step runs, never across a yield,
+        # so the consumer's code between chunks does not see (or annotate) it
+        trace = tracer.trace("stream", model=model_id, **self.trace_attrs)
+        trace.begin()
+        deltas = self._deltas()
+        error = None
+        try:
+            while True:
+                with trace.active():
+                    delta = self._step(deltas)
+                if delta is _DONE:
+                    return
+                yield delta
+        except BaseException as e:
+            error = type(e)
+            raise
+        finally:
+            with trace.active():
+                deltas.close()
+                if self.stats:
+                    tracer.annotate(**self.stats)
+            trace.finish(error)
+
+    def _step(self, deltas):
+        """The next delta, or _DONE at the end; a failure ends the reply as ERROR_REPLY."""
+        try:
+            delta = next(deltas)
+        except StopIteration:
+            return _DONE
+        except cassette.CassetteMiss:
+            raise
+        except Exception as e:
+            if self.stats:
+                self.stats["error"] = type(e).__name__
+            tracer.annotate(error=type(e).__name__)
+            self.result = ERROR_REPLY
+            return _DONE
+        if delta and self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            tracer.annotate(ttft_ms=round(self.time_to_first_token * 1000, 3))
+        return delta
+
+    def _deltas(self):
+        self.stats = stats = _new_call_stats()
+        with tracer.span("route"):
+            intent = _route(self.user_input)
+        stats["intent"] = intent.label if intent else None
+        routed = _short_circuit(intent, self.user_input)
+        if routed:
+            self.result = routed
+            yield routed[0]
+            return
+
+        if not client:
+            stats["error"] = "NoClient"
+            self.result = ("Error: API Key not found.", "0", [])
+            return
+
+        with tracer.span("response_cache"):
+            cache_key, cached = _cache_lookup(self.user_input, self.chat_history, intent, self.summary)
+        stats["response_cache_hit"] = cached is not None
+        if cached is not None:
+            self.result = _finalize(cached, self.user_input)
+            yield self.result[0]
+            return
+
+        with tracer.span("retrieval"):
+            facts = _inline_facts(self.user_input, stats)
+        tier = _route_tier(self.user_input, intent, stats)
+        with tracer.span("prompt_build"):
+            final_contents, config = _prepare(self.user_input, self.chat_history, self.session_id, intent, facts,
+                                              self.summary, cacheable=tier == cascade.STRONG)
+
+        looked_up = False
+        failures = 0
+        while True:
+            extractor = JsonTextExtractor()
+            model_parts = []
+            tool_call = shown = False
+            stats["model_calls"] += 1
+            started = time.perf_counter()
+            try:
+                # Span time includes the consumer's rendering between chunks
+                with tracer.span(f"model_stream.{stats['model_calls']}") as span:
+                    usage = None
+                    for chunk in self._chunks(tier, final_contents, config):
+                        usage = chunk.usage_metadata or usage
+                        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                            continue
+                        parts = chunk.candidates[0].content.parts
+                        if tool_call or parts[0].function_call:
+                            tool_call = True
+                            model_parts.extend(parts)
+                            continue
+                        delta = extractor.feed("".join(p.text for p in parts if p.text))
+                        shown = shown or bool(delta)
+                        yield delta
+                    span.set(tier=tier)
+                    tracer.record_usage(usage, span)
+            except Exception as e:
+                # Nothing is on screen yet, so a transient failure can still be retried unseen
+                failures += 1
+                if shown or failures >= retry_policy.attempts or not is_retryable(e):
+                    raise
+                stats["retries"] += 1
+                time.sleep(retry_policy.backoff(failures - 1))
+                continue
+            _account(stats, tier, usage, time.perf_counter() - started)
+
+            if tool_call:
+                if looked_up:
+                    raise RuntimeError("Model kept requesting tools after the fact lookup.")
+                looked_up = True
+                _append_tool_result(final_contents, types.Content(role="model", parts=model_parts))
+                tier = _escalate(stats, tier, "tool_call")
+                continue
+            try:
+                data = _parse_reply(extractor.raw(), stats)
+            except structured.StructuredOutputError:
+                # Streamed text cannot be taken back; only a fast reply that showed nothing is redone
+                if tier != cascade.FAST or shown:
+                    raise
+                tier = _escalate(stats, tier, "unparseable")
+                continue
+            stats["tier"] = tier
+            if cache_key and _cacheable(data, stats):
+                response_cache.put(cache_key, data)
+            self.result = _finalize(data, self.user_input)
+            return
+
+    @staticmethod
+    def _chunks(tier, contents, config):
+        """
+        The model stream. Its HTTP timeout bounds the wait for every chunk, the
+        first included, and closes the connection when it fires (a retryable
+        httpx timeout), so a stalled call is dropped upstream instead of left running.
+        """
+        timeout = types.HttpOptions(timeout=int(retry_policy.attempt_timeout * 1000))
+        config = config.model_copy(update={"http_options": timeout})
+        return client.models.generate_content_stream(model=_tier_model(tier), contents=contents, config=config)
+
+def get_gemini_response_stream(user_input, chat_history, session_id=None, summary=None, trace_attrs=None):
+    return StreamedReply(user_input, chat_history, session_id, summary, trace_attrs)
+
+# --- HISTORY SUMMARIES ---
+def summarize_history(previous_summary, messages):
+    """Model-backed summarizer for history.HistoryManager; runs on its background pool."""
+    transcript = "\n".join(f"{'User' if m['role'] == 'user' else 'Agent'}: {m.get('text', m.get('content', ''))}"
+                           for m in messages)
+    prompt = f"""
+    Update the running summary of a sales conversation with the new messages below.
+    Keep it under 120 words. Preserve the user's business, pain points, objections,
+    competitors mentioned and anything they agreed to. Plain text only.
+
+    Current summary: "{previous_summary}"
+    New messages:
+    {transcript}
+    """
+    # Summaries are bookkeeping, not sales copy; the fast tier is enough when the cascade is on
+    with admission.priority(admission.SPECULATIVE):
+        response = client.models.generate_content(model=cascade.FAST_MODEL if cascade.ENABLED else model_id,
+                                                  contents=prompt, config=types.GenerateContentConfig(temperature=0.0))
+    return response.text.strip()
@@ -0,0 +1,221 @@
+"""
+File: mock_gemini.py
+Description: Local stand-in for the google-genai client used by benchmarks.
+Mirrors the `client.models`, `client.aio.models` and `client.caches` surface
+logic.py relies on, with injectable latency and errors, returning real
+`types` objects so the agent code runs unchanged against it.
+"""
+import json
+import time
+import random
+import asyncio
+import itertools
+
+import httpx
+from google.genai import types, errors
+
+from text_utils import estimate_tokens
+
+DEFAULT_REPLY = {
+    "text": "Business Standard adds native eSignature inside Docs, so contracts never leave your workspace. Would it help to see how that fits your client onboarding?",
+    "score": "60",
+    "chips": ["eSignature", "Pricing", "Scheduling"],
+}
+
+class FakeModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, model, contents, config=None):
+        owner = self._owner
+        owner.calls += 1
+        latency, fail = owner._draw_fault(model=model)
+        _sleep_within(latency, config)
+        if fail:
+            raise owner._error()
+        return owner._complete(contents, config)
+
+    def generate_content_stream(self, model, contents, config=None):
+        owner = self._owner
+        owner.calls += 1
+        latency, fail = owner._draw_fault(streamed=True, model=model)
+        _sleep_within(latency, config)
+        usage = owner._usage(contents, config)
+        if fail:
+            raise owner._error()
+        if owner._wants_tool(contents, config):
+            yield _response([owner._function_call_part()], usage)
+            return
+        for i, chunk in enumerate(owner._chunks()):
+            if i:
+                time.sleep(owner.chunk_latency)
+            yield _response([types.Part.from_text(text=chunk)], usage)
+
+class FakeAsyncModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def generate_content(self, model, contents, config=None):
+        owner = self._owner
+        owner.calls += 1
+        latency, fail = owner._draw_fault(model=model)
+        await asyncio.sleep(latency)
+        if fail:
+            raise owner._error()
+        return owner._complete(contents, config)
+
+class FakeAio:
+    def __init__(self, owner):
+        self.models = FakeAsyncModels(owner)
+
+class FakeCaches:
+    """Stub of `client.caches`: stores cached prefixes, their token counts and whether they declare tools."""
+
+    def __init__(self, min_tokens=0):
+        self.min_tokens = min_tokens
+        self.store = {}
+        self.with_tools = set()
+        self.created = 0
+        self._ids = itertools.count(1)
+
+    def create(self, model, config):
+        tokens = _tokens_of(config.contents) + _tokens_of([config.system_instruction]) + _tokens_of_tools(config.tools)
+        if tokens < self.min_tokens:
+            raise ValueError(f"Cached content is too small: {tokens} < {self.min_tokens} tokens")
+        name = f"cachedContents/fake-{next(self._ids)}"
+        self.store[name] = tokens
+        if config.tools:
+            self.with_tools.add(name)
+        self.created += 1
+        return types.CachedContent(name=name, model=model, display_name=config.display_name)
+
+    def get(self, name):
+        if name not in self.store:
+            raise KeyError(name)
+        return types.CachedContent(name=name)
+
+    def delete(self, name):
+        self.store.pop(name, None)
+        self.with_tools.discard(name)
+
+class FakeClient:
+    """
+    first_token_latency: seconds before the first chunk (or full response) is sent.
+    chunk_latency: seconds between streamed chunks; a blocking call pays for all of them.
+    function_call_rate: probability that a turn first requests get_workspace_fact.
+    error_rate: probability that a call fails with `error_code` after its first-token latency.
+    tail_rate / tail_latency: probability of a straggler and the extra seconds it takes.
+    latency_sigma: lognormal spread applied to first_token_latency (0 keeps it fixed).
+    model_speed: {substring of a model name: latency multiplier}, e.g. {"lite": 0.4} for a cascade's fast tier.
+    """
+
+    def __init__(self, reply=None, first_token_latency=0.4, chunk_latency=0.03,
+                 chunk_size=12, function_call_rate=0.0, cache_min_tokens=0,
+                 error_rate=0.0, error_code=503, tail_rate=0.0, tail_latency=2.0, latency_sigma=0.0,
+                 model_speed=None, seed=0):
+        self.reply_json = json.dumps(reply or DEFAULT_REPLY)
+        self.first_token_latency = first_token_latency
+        self.chunk_latency = chunk_latency
+        self.chunk_size = chunk_size
+        self.function_call_rate = function_call_rate
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.latency_sigma = latency_sigma
+        self.model_speed = dict(model_speed or {})
+        self.calls = 0
+        self.usage = []
+        self._rng = random.Random(seed)
+        self.models = FakeModels(self)
+        self.caches = FakeCaches(cache_min_tokens)
+        self.aio = FakeAio(self)
+
+    def _draw_fault(self, streamed=False, model=None):
+        latency = self.first_token_latency
+        if self.latency_sigma:
+            # Median stays at first_token_latency; sigma widens the right tail
+            latency *= self._rng.lognormvariate(0, self.latency_sigma)
+        if not streamed:
+            latency += self.chunk_latency * len(self._chunks())
+        latency *= next((speed for name, speed in self.model_speed.items() if model and name in model), 1.0)
+        if self._rng.random() < self.tail_rate:
+            latency += self.tail_latency
+        return latency, self._rng.random() < self.error_rate
+
+    def _error(self):
+        return errors.ServerError(self.error_code, {"error": {
+            "code": self.error_code, "message": "Injected by mock_gemini", "status": "UNAVAILABLE"}})
+
+    def _complete(self, contents, config):
+        usage = self._usage(contents, config)
+        if self._wants_tool(contents, config):
+            return _response([self._function_call_part()], usage)
+        return _response([types.Part.from_text(text=self.reply_json)], usage)
+
+    def _chunks(self):
+        text = self.reply_json
+        return [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+
+    def _wants_tool(self, contents, config):
+        if config is not None and not config.tools and config.cached_content not in self.caches.with_tools:
+            return False
+        last = contents[-1]
+        if any(part.function_response for part in last.parts):
+            return False
+        return self._rng.random() < self.function_call_rate
+
+    def _usage(self, contents, config):
+        cached = 0
+        prompt = _tokens_of(contents)
+        if config is not None:
+            if config.cached_content:
+                cached = self.caches.store[config.cached_content]
+            prompt += _tokens_of([config.system_instruction]) + _tokens_of_tools(config.tools)
+        usage = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt + cached,
+            cached_content_token_count=cached,
+            candidates_token_count=estimate_tokens(self.reply_json),
+        )
+        self.usage.append(usage)
+        return usage
+
+    def _function_call_part(self):
+        return types.Part(function_call=types.FunctionCall(name="get_workspace_fact", args={"topic": "pricing"}))
+
+def _sleep_within(latency, config):
+    """Sleeps `latency`, or raises what httpx does if the request's http_options timeout fires first."""
+    timeout = config.http_options.timeout / 1000 if config and config.http_options and config.http_options.timeout else None
+    if timeout is not None and latency > timeout:
+        time.sleep(timeout)
+        raise httpx.ReadTimeout(f"no response within {timeout}s")
+    time.sleep(latency)
+
+def _tokens_of(contents):
+    if isinstance(contents, str):
+        # generate_content also takes a bare prompt string (the judge does); it is one text, not a list of them
+        return estimate_tokens(contents)
+    total = 0
+    for content in contents or []:
+        if content is None:
+            continue
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content.parts or []:
+            if part.text:
+                total += estimate_tokens(part.text)
+            elif part.function_response:
+                total += estimate_tokens(json.dumps(part.function_response.response))
+            elif part.function_call:
+                total += estimate_tokens(json.dumps(part.function_call.args))
+    return total
+
+def _tokens_of_tools(tools):
+    return sum(estimate_tokens(tool.model_dump_json(exclude_none=True)) for tool in tools or [])
+
+def _response(parts, usage=None):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=parts))],
+        usage_metadata=usage,
+    )
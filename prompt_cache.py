@@ -0,0 +1,151 @@
+"""
+File: prompt_cache.py
+Description: Prefix caching for the static part of every agent prompt.
+PrefixCache keeps hash-keyed, TTL-managed handles to server-side cached contexts
+(system instruction + knowledge base + tools). SessionContents grows each chat's
+`types.Content` list by appending only the turns added since the last call.
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from google.genai import types
+
+class PrefixCache:
+    """
+    One cached context per (model, system instruction, KB, tools, fact mode) hash.
+    Handles are refreshed `refresh_margin` seconds before they expire; if the
+    API refuses to cache (e.g. the prefix is under the model's minimum size)
+    the key is not retried for `retry_after` seconds and callers send the
+    prefix inline instead. The API call is made outside the lock; turns that
+    arrive while it is in flight keep using the old handle or go inline.
+    """
+
+    def __init__(self, ttl_seconds=3600, refresh_margin=120, retry_after=600):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}   # key -> (cache name, expires_at)
+        self._failed = {}    # key -> retry_at
+        self._creating = set()  # keys with a caches.create call in flight
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model, system_instruction, kb_text, tools, fact_mode=None):
+        digest = hashlib.sha256()
+        for piece in (model, system_instruction, kb_text, repr(tools), str(fact_mode)):
+            digest.update(piece.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def handle(self, client, model, system_instruction, kb_text, tools, fact_mode=None):
+        key = self.key(model, system_instruction, kb_text, tools, fact_mode)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - self.refresh_margin > now:
+                self.hits += 1
+                return entry[0]
+            if self._failed.get(key, 0) > now:
+                return None
+            if key in self._creating:
+                # Another turn is creating or refreshing it: use the old handle while it lasts, else go inline
+                return entry[0] if entry and entry[1] > now else None
+            self._creating.add(key)
+            self.misses += 1
+        try:
+            cached = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                display_name=f"workspace-agent-{key[:12]}",
+                system_instruction=system_instruction,
+                contents=[types.Content(role="user", parts=[types.Part.from_text(text=kb_text)])],
+                tools=tools,
+                ttl=f"{self.ttl_seconds}s",
+            ))
+        except Exception:
+            with self._lock:
+                self._failed[key] = now + self.retry_after
+            return None
+        finally:
+            with self._lock:
+                self._creating.discard(key)
+        with self._lock:
+            stale = [name for k, (name, _expires) in self._entries.items() if k != key]
+            self._entries = {key: (cached.name, now + self.ttl_seconds)}
+        # Superseded prefixes (old prompt or KB version) are released best-effort
+        for name in stale:
+            try:
+                client.caches.delete(name=name)
+            except Exception:
+                pass
+        return cached.name
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._failed.clear()
+
+class SessionContents:
+    """
+    The `types.Content` list for one conversation. sync() converts only the
+    messages appended since the previous call. A sliding window (older
+    messages dropped from the front, new ones appended) is handled by
+    trimming the cached list; any other edit rebuilds it from scratch.
+    """
+
+    def __init__(self, to_content):
+        self._to_content = to_content
+        self._signatures = []
+        self.contents = []
+
+    @staticmethod
+    def _signature(msg):
+        return (msg["role"], msg.get("text", msg.get("content", "")))
+
+    def _overlap(self, chat_history):
+        """How many cached messages to drop from the front so the rest prefixes chat_history."""
+        signatures = self._signatures
+        for drop in range(len(signatures)):
+            kept = len(signatures) - drop
+            if kept > len(chat_history):
+                continue
+            if (self._signature(chat_history[0]) != signatures[drop]
+                    or self._signature(chat_history[kept - 1]) != signatures[-1]):
+                continue
+            # Pure appends are trusted on their endpoints; a shifted window is short, so verify it fully
+            if drop == 0 or signatures[drop:] == [self._signature(m) for m in chat_history[:kept]]:
+                return drop
+        return None
+
+    def sync(self, chat_history):
+        drop = self._overlap(chat_history) if self._signatures else 0
+        if drop is None:
+            self._signatures, self.contents = [], []
+        elif drop:
+            del self._signatures[:drop]
+            del self.contents[:drop]
+        for msg in chat_history[len(self._signatures):]:
+            self._signatures.append(self._signature(msg))
+            self.contents.append(self._to_content(msg))
+        return list(self.contents)
+
+class SessionContentsRegistry:
+    """Bounded LRU of SessionContents keyed by session id."""
+
+    def __init__(self, to_content, max_sessions=1000):
+        self._to_content = to_content
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contents_for(self, session_id, chat_history):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = SessionContents(self._to_content)
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return session.sync(chat_history)
@@ -0,0 +1,203 @@
+"""
+File: resilience.py
+Description: Deadlines, jittered retries and hedged requests for async model calls.
+Also hosts the background event loop that lets synchronous callers (Streamlit,
+eval threads) run the async pipeline without creating a loop per call.
+"""
+import asyncio
+import random
+import threading
+import contextlib
+import contextvars
+from collections import deque
+
+import httpx
+from google.genai import errors
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+def is_retryable(exc):
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TransportError, ConnectionError)):
+        return True
+    if isinstance(exc, errors.APIError):
+        return exc.code in RETRYABLE_STATUS
+    return False
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, used to derive the hedge delay."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class RetryPolicy:
+    """
+    attempts: total tries per call (1 = no retry).
+    attempt_timeout: deadline in seconds for each try, hedge included, counted
+    from admission (see queued()).
+    base_delay / max_delay: exponential backoff bounds; the sleep is drawn
+    uniformly from [0, min(max_delay, base_delay * 2**n)] ("full jitter").
+    hedge: send a duplicate once a try has run for the tracked p95 latency
+    (or hedge_delay until enough samples exist) and keep whichever answers first.
+    """
+
+    def __init__(self, attempts=3, attempt_timeout=30.0, base_delay=0.5, max_delay=8.0,
+                 hedge=False, hedge_delay=2.0, hedge_percentile=95, min_hedge_delay=0.05):
+        self.attempts = max(1, attempts)
+        self.attempt_timeout = attempt_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+
+    def backoff(self, retry_number, rng=random):
+        return rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry_number)))
+
+class CallStats:
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+class _AttemptClock:
+    """When a try started, for its deadline and hedge timer; paused while the call waits for admission."""
+
+    def __init__(self, loop):
+        self._loop = loop
+        self.started = loop.time()
+        self.queued = False
+        self.changed = asyncio.Event()
+
+    def hold(self):
+        self.queued = True
+        self.changed.set()
+
+    def resume(self):
+        self.queued = False
+        self.started = self._loop.time()
+        self.changed.set()
+
+_clock = contextvars.ContextVar("attempt_clock", default=None)
+
+@contextlib.contextmanager
+def queued():
+    """
+    Wraps a wait for admission inside a try: the try's deadline and hedge
+    timer stop while it runs and restart once it ends. The admission queue
+    bounds the wait with its own per-class deadline.
+    """
+    clock = _clock.get()
+    if clock is None:
+        yield
+        return
+    clock.hold()
+    try:
+        yield
+    finally:
+        clock.resume()
+
+def _start(make_call, loop):
+    clock = _AttemptClock(loop)
+    token = _clock.set(clock)
+    try:
+        # The task copies the context here, so the call sees its own clock
+        return asyncio.ensure_future(make_call()), clock
+    finally:
+        _clock.reset(token)
+
+async def _attempt(make_call, timeout, hedge_after, stats, tracker):
+    """
+    One try: the primary call plus, if hedge_after is set, a duplicate sent once
+    the primary has run that long; the first success wins. Both timers count
+    from admission, so a queued call is never timed out here or hedged.
+    """
+    loop = asyncio.get_running_loop()
+    primary, clock = _start(make_call, loop)
+    pending, backup, error = {primary}, None, None
+    try:
+        while True:
+            clock.changed.clear()
+            wait = None
+            if not clock.queued:
+                elapsed = loop.time() - clock.started
+                if elapsed >= timeout:
+                    raise asyncio.TimeoutError(f"no response within {timeout}s")
+                wait = timeout - elapsed
+                if hedge_after is not None and backup is None:
+                    if elapsed >= hedge_after:
+                        stats.hedges += 1
+                        backup, _ = _start(make_call, loop)
+                        pending.add(backup)
+                        continue
+                    wait = min(wait, hedge_after - elapsed)
+            changed = asyncio.ensure_future(clock.changed.wait())
+            try:
+                done, _ = await asyncio.wait(pending | {changed}, timeout=wait,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                changed.cancel()
+            for task in done - {changed}:
+                pending.discard(task)
+                if task.exception() is None:
+                    if task is backup:
+                        stats.hedge_wins += 1
+                    if tracker:
+                        tracker.record(loop.time() - clock.started)
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def call_with_retries(make_call, policy, tracker=None, stats=None):
+    """Awaits make_call() under the policy; raises the last error once retries are exhausted."""
+    stats = stats or CallStats()
+    for attempt in range(policy.attempts):
+        stats.attempts += 1
+        hedge_after = None
+        if policy.hedge:
+            delay = (tracker.percentile(policy.hedge_percentile) if tracker else None) or policy.hedge_delay
+            hedge_after = max(policy.min_hedge_delay, delay)
+        try:
+            return await _attempt(make_call, policy.attempt_timeout, hedge_after, stats, tracker)
+        except Exception as exc:
+            if attempt + 1 >= policy.attempts or not is_retryable(exc):
+                raise
+            stats.retries += 1
+            await asyncio.sleep(policy.backoff(attempt))
+
+class LoopThread:
+    """A daemon thread running one event loop; run() submits a coroutine and blocks for its result."""
+
+    def __init__(self, name="gemini-async"):
+        self._name = name
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=self._name, daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started()).result()
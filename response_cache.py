@@ -0,0 +1,107 @@
+"""
+File: response_cache.py
+Description: Two-tier cache of parsed model replies for deterministic turns.
+A bounded in-memory LRU with TTL sits in front of an optional SQLite file that
+every Streamlit worker process can share. Keys are content hashes, so a new
+prompt, KB or model version simply stops matching old entries.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl_seconds=3600, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_path = disk_path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if disk_path:
+            self._db().execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def key(**parts):
+        payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.disk_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._memory[key]
+
+        if self.disk_path:
+            try:
+                row = self._db().execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row:
+                value = json.loads(row[0])
+                with self._lock:
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, value, expires_at)
+        if self.disk_path:
+            try:
+                self._db().execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires_at),
+                )
+            except sqlite3.Error:
+                pass
+
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.disk_path:
+            self._db().execute("DELETE FROM responses")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "entries": len(self._memory),
+        }
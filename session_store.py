@@ -0,0 +1,323 @@
+"""
+File: session_store.py
+Description: Externalised chat sessions so app.py can run as several replicas.
+A SessionStore keeps recently used ChatSessions in a bounded in-memory LRU in
+front of a backend. Sessions are loaded lazily on first access and written
+back once per turn: only the messages added since the last save, plus a small
+state record (chips, history summary, app meta). Turns are stored one row per
+message with a one-letter role, so an idle session costs a few hundred bytes
+on disk and nothing in memory once it falls out of the LRU. Saves are
+compare-and-swap on a per-session version: if another replica saved the
+session first, the unsaved messages are replayed on top of its copy.
+
+Backends: MemoryBackend (one process, the default) and SqliteBackend (a file
+every replica on the host, or a shared volume, can open). Sessions not saved
+for SESSION_TTL seconds are purged, checked at most once a minute when a new
+session is created, so closed and abandoned tabs do not accumulate.
+Environment: SESSION_STORE_PATH (enables SQLite), SESSION_CACHE_SIZE, SESSION_TTL.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from chat_session import ChatSession
+
+_ROLE_CODES = {"user": "u", "bot": "b"}
+_ROLE_NAMES = {code: role for role, code in _ROLE_CODES.items()}
+
+class VersionConflict(RuntimeError):
+    """The stored session is not at the version the writer last saw."""
+
+def encode_state(session):
+    summary, folded = session.history_manager.state()
+    return json.dumps({"c": session.suggestions, "s": summary, "f": folded, "m": session.meta},
+                      separators=(",", ":"), ensure_ascii=False)
+
+def decode(session_id, state, rows, version=None):
+    state = json.loads(state)
+    history = [{"role": _ROLE_NAMES.get(role, role), "text": text} for role, text in rows]
+    session = ChatSession(session_id, history, state["c"], state["s"], state["f"], state["m"])
+    session.saved = len(history)
+    session.version = version
+    return session
+
+class MemoryBackend:
+    """Process-local storage with the same interface as SqliteBackend."""
+
+    shared = False
+
+    def __init__(self):
+        self._sessions = {}     # id -> [state, version, rows, updated]
+        self._lock = threading.Lock()
+
+    def load(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return (entry[0], entry[1], list(entry[2])) if entry else None
+
+    def version(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry[1] if entry else None
+
+    def append(self, session_id, start, rows, state, expected=None):
+        """Replaces messages from `start` on and the state; raises VersionConflict unless at `expected` (None: new)."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if (entry[1] if entry else None) != expected:
+                raise VersionConflict(session_id)
+            if entry is None:
+                entry = self._sessions[session_id] = [state, 0, [], 0.0]
+            del entry[2][start:]
+            entry[2].extend(rows)
+            entry[0] = state
+            entry[1] += 1
+            entry[3] = time.time()
+            return entry[1]
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def purge(self, max_idle_seconds):
+        """Deletes sessions untouched for max_idle_seconds; returns how many."""
+        cutoff = time.time() - max_idle_seconds
+        with self._lock:
+            expired = [sid for sid, entry in self._sessions.items() if entry[3] < cutoff]
+            for sid in expired:
+                del self._sessions[sid]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._sessions)
+
+class SqliteBackend:
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                   "version INTEGER NOT NULL, updated REAL NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS turns (session_id TEXT NOT NULL, seq INTEGER NOT NULL, "
+                   "role TEXT NOT NULL, text TEXT NOT NULL, PRIMARY KEY (session_id, seq)) WITHOUT ROWID")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # A power loss may drop the last turn; a crash of the app process never does
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, session_id):
+        db = self._db()
+        row = db.execute("SELECT state, version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        rows = db.execute("SELECT role, text FROM turns WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return row[0], row[1], rows
+
+    def version(self, session_id):
+        row = self._db().execute("SELECT version FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def append(self, session_id, start, rows, state, expected=None):
+        """Replaces messages from `start` on and the state; raises VersionConflict unless at `expected` (None: new)."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if expected is None:
+                # Fails on the primary key if another replica created it first
+                try:
+                    db.execute("INSERT INTO sessions VALUES (?, ?, 1, ?)", (session_id, state, time.time()))
+                except sqlite3.IntegrityError:
+                    raise VersionConflict(session_id) from None
+            elif not db.execute("UPDATE sessions SET state = ?, version = version + 1, updated = ? "
+                                "WHERE id = ? AND version = ?", (state, time.time(), session_id, expected)).rowcount:
+                raise VersionConflict(session_id)
+            db.execute("DELETE FROM turns WHERE session_id = ? AND seq >= ?", (session_id, start))
+            db.executemany("INSERT INTO turns VALUES (?, ?, ?, ?)",
+                           [(session_id, start + i, role, text) for i, (role, text) in enumerate(rows)])
+            version = 1 if expected is None else expected + 1
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return version
+
+    def delete(self, session_id):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+        db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        db.execute("COMMIT")
+
+    def purge(self, max_idle_seconds):
+        """Deletes sessions untouched for max_idle_seconds; returns how many."""
+        db = self._db()
+        cutoff = time.time() - max_idle_seconds
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM turns WHERE session_id IN (SELECT id FROM sessions WHERE updated < ?)", (cutoff,))
+        removed = db.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,)).rowcount
+        db.execute("COMMIT")
+        return removed
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+class SessionStore:
+    """
+    LRU of live ChatSessions over a backend. With a shared backend every get()
+    compares the cached version with the stored one, so a turn served by
+    another replica is picked up instead of being overwritten. lock(id)
+    serialises turns on one session within this process.
+    """
+
+    # Saves retried after a conflict before giving up
+    MAX_REBASES = 3
+
+    def __init__(self, backend=None, max_entries=256, ttl=0, purge_interval=60.0):
+        self.backend = MemoryBackend() if backend is None else backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.hits = 0
+        self.loads = 0
+        self.saves = 0
+        self.evictions = 0
+        self.purged = 0
+        self.conflicts = 0
+        self._purged_at = time.monotonic()
+        self._cache = OrderedDict()     # id -> ChatSession
+        self._lock = threading.Lock()
+        self._session_locks = [threading.RLock() for _ in range(64)]
+
+    def lock(self, session_id):
+        """Re-entrant lock for one session id (striped, so it costs nothing per session)."""
+        return self._session_locks[hash(session_id) % len(self._session_locks)]
+
+    def get(self, session_id):
+        """The session, from the LRU or loaded from the backend; None if it does not exist."""
+        with self._lock:
+            session = self._cache.get(session_id)
+        if session is not None:
+            if not self.backend.shared or self.backend.version(session_id) == session.version:
+                with self._lock:
+                    if session_id in self._cache:
+                        self._cache.move_to_end(session_id)
+                    self.hits += 1
+                return session
+        record = self.backend.load(session_id)
+        if record is None:
+            return None
+        state, version, rows = record
+        session = decode(session_id, state, rows, version)
+        with self._lock:
+            self.loads += 1
+        self._remember(session)
+        return session
+
+    def create(self):
+        self._maybe_purge()
+        session = ChatSession()
+        self._remember(session)
+        return session
+
+    def save(self, session):
+        """
+        Writes the messages added since the last save plus the session state and
+        returns the saved session. That is `session` itself unless another
+        replica saved first, in which case it is the stored copy with this
+        copy's unsaved messages and current state applied on top.
+        """
+        with self.lock(session.session_id):
+            for attempt in range(self.MAX_REBASES + 1):
+                start = session.saved
+                rows = [(_ROLE_CODES.get(msg["role"], msg["role"]), msg["text"]) for msg in session.history[start:]]
+                try:
+                    version = self.backend.append(session.session_id, start, rows, encode_state(session),
+                                                  expected=session.version)
+                    break
+                except VersionConflict:
+                    if attempt == self.MAX_REBASES:
+                        raise
+                    session = self._rebase(session)
+            session.saved = len(session.history)
+            session.version = version
+            with self._lock:
+                self.saves += 1
+                if session.session_id in self._cache:
+                    self._cache[session.session_id] = session
+        return session
+
+    def _rebase(self, session):
+        record = self.backend.load(session.session_id)
+        if record is None:
+            # Deleted or purged meanwhile: store the whole transcript again
+            session.saved, session.version = 0, None
+            return session
+        state, version, rows = record
+        current = decode(session.session_id, state, rows, version)
+        for msg in session.history[session.saved:]:
+            current._append(msg)
+        current.suggestions = session.suggestions
+        current.meta.update(session.meta)
+        with self._lock:
+            self.conflicts += 1
+        return current
+
+    def delete(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+        self.backend.delete(session_id)
+
+    def purge(self):
+        """Deletes sessions idle for longer than `ttl` from the backend and the LRU; returns how many."""
+        removed = self.backend.purge(self.ttl)
+        if removed:
+            with self._lock:
+                saved = [sid for sid, session in self._cache.items() if session.version is not None]
+            gone = [sid for sid in saved if self.backend.version(sid) is None]
+            with self._lock:
+                for sid in gone:
+                    self._cache.pop(sid, None)
+                self.purged += removed
+        return removed
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        with self._lock:
+            if not self.ttl or now - self._purged_at < self.purge_interval:
+                return
+            self._purged_at = now
+        self.purge()
+
+    def _remember(self, session):
+        with self._lock:
+            self._cache[session.session_id] = session
+            self._cache.move_to_end(session.session_id)
+            evicted = []
+            while len(self._cache) > self.max_entries:
+                evicted.append(self._cache.popitem(last=False)[1])
+                self.evictions += 1
+        for old in evicted:
+            # Turns are saved as they happen; this only catches a session that never was
+            if old.version is None or old.saved < len(old.history):
+                self.save(old)
+
+    def __len__(self):
+        return len(self._cache)
+
+def from_env():
+    path = os.getenv("SESSION_STORE_PATH")
+    backend = SqliteBackend(path) if path else MemoryBackend()
+    return SessionStore(backend, max_entries=int(os.getenv("SESSION_CACHE_SIZE", "256")),
+                        ttl=float(os.getenv("SESSION_TTL", "86400")))
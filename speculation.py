@@ -0,0 +1,109 @@
+"""
+File: speculation.py
+Description: Speculative pre-generation of replies for displayed suggestion chips.
+When chips are shown, each one is sent to the model on a small background pool.
+If the user then clicks a chip, its finished (or still running) future is used
+instead of a fresh call; every other branch is cancelled or counted as wasted.
+A branch is only used if the history window and summary it was generated from
+are still the ones the live turn would send.
+"""
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+
+def _state_key(chat_history, summary):
+    return hashlib.sha256(json.dumps([chat_history, summary or ""], sort_keys=True, default=str).encode()).hexdigest()
+
+class Speculator:
+    """
+    Branches live in a plain dict owned by the caller's session
+    ({chip: (future, state key)}), so the pool is shared process-wide while
+    state stays per session.
+    """
+
+    def __init__(self, generate, max_workers=4, per_session_cap=3, skip=("end chat",)):
+        self._generate = generate
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculate")
+        self.per_session_cap = per_session_cap
+        self.skip = {s.lower() for s in skip}
+        self.launched = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.cancelled = 0
+        self.wasted = 0
+        self._lock = threading.Lock()
+
+    def launch(self, branches, chips, chat_history, **context):
+        """context (session_id, summary, ...) is passed through to the generate callable."""
+        self.discard(branches)
+        history = list(chat_history)
+        key = _state_key(history, context.get("summary"))
+        for chip in chips:
+            if len(branches) >= self.per_session_cap:
+                break
+            if chip.lower() in self.skip or chip in branches:
+                continue
+            branches[chip] = (self._pool.submit(self._run, chip, history, context), key)
+            with self._lock:
+                self.launched += 1
+
+    def _run(self, chip, history, context):
+        # A guess must never hold up a live turn for quota
+        with admission.priority(admission.SPECULATIVE):
+            return self._generate(chip, history, **context)
+
+    def take(self, branches, user_input, chat_history, summary=None):
+        """
+        The future speculated for user_input (or None) if it was generated from
+        this chat_history and summary; all other branches are dropped.
+        """
+        branch = branches.pop(user_input, None)
+        if branch is not None and branch[1] != _state_key(list(chat_history), summary):
+            # The session moved on (another tab, a restored copy, a new summary) since the guess was made
+            branches[user_input] = branch
+            branch = None
+            with self._lock:
+                self.stale += 1
+        elif branches or branch is not None:
+            with self._lock:
+                if branch is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        self.discard(branches)
+        return branch[0] if branch else None
+
+    def discard(self, branches):
+        for future, _key in branches.values():
+            # A branch that never started costs nothing; one that ran (or is running) was a paid call
+            cancelled = future.cancel()
+            with self._lock:
+                if cancelled:
+                    self.cancelled += 1
+                else:
+                    self.wasted += 1
+        branches.clear()
+
+    def stats(self):
+        taken = self.hits + self.misses + self.stale
+        return {
+            "launched": self.launched,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": (self.hits / taken) if taken else 0.0,
+            "cancelled": self.cancelled,
+            "wasted_calls": self.wasted,
+        }
+
+    def render(self):
+        """Prometheus text lines for the tracing metrics endpoint."""
+        stats = self.stats()
+        lines = ["# TYPE agent_speculation_branches_total counter"]
+        for outcome in ("launched", "hits", "misses", "stale", "cancelled", "wasted_calls"):
+            lines.append(f'agent_speculation_branches_total{{outcome="{outcome}"}} {stats[outcome]}')
+        return lines
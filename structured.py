@@ -0,0 +1,206 @@
+"""
+File: structured.py
+Description: Shared structured-output layer for the agent reply and the judge verdict.
+Declares the response schemas sent to Gemini and a tolerant parser that
+repairs the usual defects (code fences, prose around the JSON, trailing
+commas, truncated strings/brackets, numeric or out-of-range scores) locally,
+so a slightly malformed reply costs nothing instead of an error turn and a
+resend. Every parse is counted in `parse_stats`.
+"""
+import re
+import json
+import threading
+from collections import Counter
+
+from google.genai import types
+
+REPLY_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "text": types.Schema(type=types.Type.STRING),
+        "score": types.Schema(type=types.Type.STRING, description="Purchase readiness from 0 to 100"),
+        "chips": types.Schema(type=types.Type.ARRAY, items=types.Schema(type=types.Type.STRING)),
+    },
+    required=["text", "score", "chips"],
+    property_ordering=["text", "score", "chips"],
+)
+
+_VERDICT_PROPERTIES = {
+    "grade": types.Schema(type=types.Type.STRING, enum=["PASS", "FAIL"]),
+    "rationale": types.Schema(type=types.Type.STRING),
+}
+VERDICT_SCHEMA = types.Schema(type=types.Type.OBJECT, properties=_VERDICT_PROPERTIES,
+                              required=["grade", "rationale"], property_ordering=["grade", "rationale"])
+BATCH_VERDICT_SCHEMA = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(type=types.Type.OBJECT,
+                       properties={"id": types.Schema(type=types.Type.STRING), **_VERDICT_PROPERTIES},
+                       required=["id", "grade", "rationale"], property_ordering=["id", "grade", "rationale"]),
+)
+
+class StructuredOutputError(ValueError):
+    pass
+
+class ParseStats:
+    """Thread-safe counters: clean parses, repaired parses (by defect) and unrecoverable failures."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clean = 0
+        self.repaired = 0
+        self.failed = 0
+        self.defects = Counter()
+
+    def record(self, defects=(), failed=False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+            elif defects:
+                self.repaired += 1
+            else:
+                self.clean += 1
+            self.defects.update(defects)
+
+    def snapshot(self):
+        with self._lock:
+            return {"clean": self.clean, "repaired": self.repaired, "failed": self.failed,
+                    "defects": dict(self.defects)}
+
+parse_stats = ParseStats()
+
+_FENCE_RE = re.compile(r"```[A-Za-z]*\s*(.*?)(?:```|$)", re.DOTALL)
+_DANGLING_KEY_RE = re.compile(r'(,|(?<=\{))\s*"(?:[^"\\]|\\.)*"\s*(:\s*([-\w.]*)?)?\s*$')
+_PARTIAL_LITERAL_RE = re.compile(r"(:|,|\[)\s*(t|tr|tru|f|fa|fal|fals|n|nu|nul|-)$")
+_CLOSERS = {"{": "}", "[": "]"}
+_OPEN_VALUE_RE = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:\s*$')
+# The only string worth keeping when cut off: prose reads fine truncated, a score or grade does not
+_REPAIRABLE_KEYS = {"text"}
+
+def _scan(text, defects):
+    """Single pass over the first JSON value: drops trailing commas and text after it, closes what is left open."""
+    out = []
+    stack = []
+    in_string = escape = False
+    string_start = 0
+    for i, ch in enumerate(text):
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+            string_start = len(out)
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            tail = "".join(out).rstrip()
+            if tail.endswith(","):
+                defects.append("trailing_comma")
+                out = list(tail[:-1])
+            if stack:
+                stack.pop()
+            out.append(ch)
+            if not stack:
+                if text[i + 1:].strip():
+                    defects.append("trailing_text")
+                return "".join(out)
+            continue
+        out.append(ch)
+
+    if not in_string and not stack:
+        return "".join(out)
+    defects.append("truncated")
+    if in_string and stack and stack[-1] == "[":
+        # A cut-off list item ("Pri") is worse than a missing one
+        del out[string_start:]
+    elif in_string:
+        key = _OPEN_VALUE_RE.search("".join(out[:string_start])) if stack and stack[-1] == "{" else None
+        if key and key.group(1) not in _REPAIRABLE_KEYS:
+            # {"text": "...", "score": "8  ->  {"text": "..."; the field falls back to its default
+            del out[key.start():]
+        else:
+            if escape:
+                out.pop()
+            out.append('"')
+    repaired = "".join(out).rstrip()
+    if stack and stack[-1] == "{":
+        # {"text": "...", "sco  ->  {"text": "..."
+        repaired = _DANGLING_KEY_RE.sub("", repaired)
+    repaired = _PARTIAL_LITERAL_RE.sub(r"\1", repaired).rstrip().rstrip(",:").rstrip()
+    return repaired + "".join(_CLOSERS[c] for c in reversed(stack))
+
+def parse_json(text, stats=parse_stats, defects=None):
+    """
+    json.loads with local repairs; raises StructuredOutputError if nothing
+    parseable remains. Pass a list as `defects` to receive the repairs applied.
+    """
+    text = (text or "").strip()
+    try:
+        value = json.loads(text)
+        stats.record()
+        return value
+    except ValueError:
+        pass
+
+    defects = [] if defects is None else defects
+    if "```" in text:
+        match = _FENCE_RE.search(text)
+        if match:
+            defects.append("fence")
+            text = match.group(1).strip()
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        stats.record(failed=True)
+        raise StructuredOutputError("no JSON object or array in model output")
+    if min(starts) > 0:
+        defects.append("prose")
+        text = text[min(starts):]
+    try:
+        value = json.loads(_scan(text, defects))
+    except ValueError as e:
+        stats.record(defects, failed=True)
+        raise StructuredOutputError(f"unrepairable model output: {e}") from e
+    stats.record(defects)
+    return value
+
+# --- COERCION ---
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+def coerce_score(value, default="50"):
+    """85, 85.0, "85%", "85/100" -> "85"; clamped to 0-100."""
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        match = _NUMBER_RE.search(str(value or ""))
+        if not match:
+            return default
+        number = float(match.group())
+    return str(int(round(min(100, max(0, number)))))
+
+def coerce_reply(data):
+    """Normalises a parsed reply to {text: str, score: "0".."100", chips: [str]}."""
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        data = data[0]
+    if not isinstance(data, dict):
+        raise StructuredOutputError(f"expected a JSON object, got {type(data).__name__}")
+    chips = data.get("chips", [])
+    if isinstance(chips, str):
+        chips = [chips] if chips.strip() else []
+    chips = [str(c).strip() for c in chips if isinstance(c, (str, int, float)) and str(c).strip()]
+    return {"text": str(data.get("text", "")), "score": coerce_score(data.get("score", "50")), "chips": chips}
+
+def parse_reply(text, stats=parse_stats, defects=None):
+    return coerce_reply(parse_json(text, stats, defects))
+
+def coerce_verdict(data):
+    if not isinstance(data, dict):
+        return {"grade": "ERROR", "rationale": "Judge returned no verdict."}
+    grade = str(data.get("grade", "")).strip().upper()
+    return {"grade": grade if grade in ("PASS", "FAIL") else "ERROR", "rationale": str(data.get("rationale", ""))}
@@ -0,0 +1,27 @@
+"""
+File: text_utils.py
+Description: Shared text helpers (tokenizing and cheap token estimates).
+"""
+import re
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i if in is it me my of on or so "
+    "that the this to we what when with you your our us".split()
+)
+
+def tokenize(text):
+    """Lowercased word terms with stopwords dropped and plurals folded."""
+    terms = []
+    for word in WORD_RE.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for budgeting Gemini prompts
+    return (len(text) + 3) // 4
@@ -0,0 +1,372 @@
+"""
+File: tracing.py
+Description: Lightweight per-stage tracing for the agent pipeline.
+One trace per agent turn, one span per stage (monotonic timings), plus token
+usage, round trips, cache hits and the error class. Finished traces go to
+pluggable sinks: an in-process ring buffer, a JSONL file and a Prometheus
+text endpoint. When tracing is off, trace()/span() hand back a shared no-op.
+
+Usage: python tracing.py report traces.jsonl
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import argparse
+import threading
+import contextlib
+import contextvars
+from collections import deque, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+    def begin(self):
+        pass
+
+    def finish(self, exc_type=None):
+        pass
+
+    def active(self):
+        return self
+
+_NOOP = _NoopSpan()
+
+class Span:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.attrs = {}
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.spans.append(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin):
+        return {"name": self.name, "start_ms": round((self.start - origin) * 1000, 3),
+                "duration_ms": round((self.end - self.start) * 1000, 3), **({"attrs": self.attrs} if self.attrs else {})}
+
+class Trace:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.attrs = dict(attrs)
+        self.spans = []
+        self.tokens = defaultdict(int)
+        self.started_at = time.time()
+        self.start = None
+        self.end = None
+        self._token = None
+
+    def __enter__(self):
+        self.begin()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.finish(exc_type)
+        return False
+
+    def begin(self):
+        self.start = time.perf_counter()
+
+    def finish(self, exc_type=None):
+        """Closes the trace and hands it to the sinks; begin()/finish() time it without making it current."""
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attrs.setdefault("error", exc_type.__name__)
+        self.tracer._emit(self)
+
+    @contextlib.contextmanager
+    def active(self):
+        """Makes this the current trace inside the block only, e.g. around each step of a generator."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "ts": round(self.started_at, 3),
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "attrs": self.attrs,
+            "tokens": dict(self.tokens),
+            "spans": [span.to_dict(self.start) for span in self.spans],
+        }
+
+_current = contextvars.ContextVar("current_trace", default=None)
+
+class Tracer:
+    def __init__(self, enabled=False, sinks=None):
+        self.enabled = enabled
+        self.sinks = list(sinks or [])
+
+    def trace(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP
+        return Trace(self, name, attrs)
+
+    def span(self, name):
+        trace = _current.get()
+        if trace is None:
+            return _NOOP
+        return Span(trace, name)
+
+    def annotate(self, **attrs):
+        trace = _current.get()
+        if trace is not None:
+            trace.attrs.update(attrs)
+
+    def record_usage(self, usage, span=None):
+        """Adds a response's usage_metadata to the current trace (and the given span)."""
+        trace = _current.get()
+        if trace is None or usage is None:
+            return
+        counts = {
+            "prompt": usage.prompt_token_count or 0,
+            "cached": usage.cached_content_token_count or 0,
+            "output": usage.candidates_token_count or 0,
+        }
+        for kind, value in counts.items():
+            trace.tokens[kind] += value
+        if span is not None:
+            span.set(**{f"{kind}_tokens": value for kind, value in counts.items()})
+
+    def add_collector(self, collect):
+        for sink in self.sinks:
+            if isinstance(sink, PrometheusSink):
+                sink.collectors.append(collect)
+
+    def _emit(self, trace):
+        record = trace.to_dict()
+        for sink in self.sinks:
+            try:
+                sink.write(record)
+            except Exception:
+                pass
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv("TRACING", "0") != "1":
+            return cls(enabled=False)
+        sinks = [RingBufferSink(int(os.getenv("TRACE_BUFFER", "1000")))]
+        if os.getenv("TRACE_JSONL"):
+            sinks.append(JsonlSink(os.getenv("TRACE_JSONL")))
+        if os.getenv("TRACE_PROM_PORT"):
+            prometheus = PrometheusSink()
+            prometheus.serve(int(os.getenv("TRACE_PROM_PORT")))
+            sinks.append(prometheus)
+        return cls(enabled=True, sinks=sinks)
+
+# --- SINKS ---
+class RingBufferSink:
+    def __init__(self, size=1000):
+        self.records = deque(maxlen=size)
+
+    def write(self, record):
+        self.records.append(record)
+
+class JsonlSink:
+    """Appends records from a writer thread, so a trace closing on the event loop never waits on the disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._drain, name="trace-jsonl", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        self._queue.put(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _drain(self):
+        while True:
+            lines = [self._queue.get()]
+            while not self._queue.empty():
+                lines.append(self._queue.get())
+            closing = lines[-1] is None
+            lines = [line for line in lines if line is not None]
+            if lines:
+                try:
+                    with open(self.path, "a") as f:
+                        f.write("".join(lines))
+                except OSError:
+                    pass
+            if closing:
+                return
+
+    def close(self):
+        """Writes out queued records and stops the writer."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+class PrometheusSink:
+    """Aggregates traces into Prometheus text-format histograms and counters."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = defaultdict(lambda: [0] * len(self.BUCKETS))
+        self._sum = defaultdict(float)
+        self._count = defaultdict(int)
+        self._tokens = defaultdict(int)
+        self._requests = defaultdict(int)
+        self._round_trips = 0
+        self._cache_hits = 0
+        self._tiers = defaultdict(int)
+        self._escalations = 0
+        # Callables returning extra metric lines (e.g. the admission scheduler's queues)
+        self.collectors = []
+
+    def write(self, record):
+        stages = [(span["name"], span["duration_ms"] / 1000) for span in record["spans"]]
+        stages.append(("total", record["duration_ms"] / 1000))
+        attrs = record["attrs"]
+        stages.extend((f"tier.{tier}", ms / 1000) for tier, ms in (attrs.get("tier_ms") or {}).items())
+        with self._lock:
+            for stage, seconds in stages:
+                buckets = self._buckets[stage]
+                for i, bound in enumerate(self.BUCKETS):
+                    if seconds <= bound:
+                        buckets[i] += 1
+                self._sum[stage] += seconds
+                self._count[stage] += 1
+            for kind, value in record["tokens"].items():
+                self._tokens[kind] += value
+            self._requests[attrs.get("error") or "none"] += 1
+            self._round_trips += attrs.get("model_calls", 0)
+            self._cache_hits += 1 if attrs.get("response_cache_hit") else 0
+            if attrs.get("tier"):
+                self._tiers[attrs["tier"]] += 1
+            self._escalations += 1 if attrs.get("escalated") else 0
+
+    def render(self):
+        lines = ["# TYPE agent_stage_seconds histogram"]
+        with self._lock:
+            for stage in sorted(self._count):
+                for bound, count in zip(self.BUCKETS, self._buckets[stage]):
+                    lines.append(f'agent_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'agent_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {self._count[stage]}')
+                lines.append(f'agent_stage_seconds_sum{{stage="{stage}"}} {self._sum[stage]:.6f}')
+                lines.append(f'agent_stage_seconds_count{{stage="{stage}"}} {self._count[stage]}')
+            lines.append("# TYPE agent_tokens_total counter")
+            for kind in sorted(self._tokens):
+                lines.append(f'agent_tokens_total{{kind="{kind}"}} {self._tokens[kind]}')
+            lines.append("# TYPE agent_requests_total counter")
+            for error in sorted(self._requests):
+                lines.append(f'agent_requests_total{{error="{error}"}} {self._requests[error]}')
+            lines.append("# TYPE agent_round_trips_total counter")
+            lines.append(f"agent_round_trips_total {self._round_trips}")
+            lines.append("# TYPE agent_response_cache_hits_total counter")
+            lines.append(f"agent_response_cache_hits_total {self._cache_hits}")
+            lines.append("# TYPE agent_model_tier_total counter")
+            for tier in sorted(self._tiers):
+                lines.append(f'agent_model_tier_total{{tier="{tier}"}} {self._tiers[tier]}')
+            lines.append("# TYPE agent_cascade_escalations_total counter")
+            lines.append(f"agent_cascade_escalations_total {self._escalations}")
+        for collect in self.collectors:
+            lines.extend(collect())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="trace-metrics", daemon=True).start()
+        return server
+
+tracer = Tracer.from_env()
+
+# --- REPORT ---
+def _percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def report(records, out=sys.stdout):
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    tokens = defaultdict(int)
+    speculation = defaultdict(int)
+    for record in records:
+        durations["total"].append(record["duration_ms"])
+        for span in record["spans"]:
+            durations[span["name"]].append(span["duration_ms"])
+        for tier, ms in (record["attrs"].get("tier_ms") or {}).items():
+            durations[f"tier.{tier}"].append(ms)
+        errors[record["attrs"].get("error") or "ok"] += 1
+        if record["attrs"].get("speculation"):
+            speculation[record["attrs"]["speculation"]] += 1
+        for kind, value in record.get("tokens", {}).items():
+            tokens[kind] += value
+
+    out.write(f"{'stage':<18} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}\n")
+    for stage in sorted(durations, key=lambda s: (s == "total", s)):
+        ordered = sorted(durations[stage])
+        out.write(f"{stage:<18} {len(ordered):>6} {_percentile(ordered, 50):>9.2f} "
+                  f"{_percentile(ordered, 95):>9.2f} {_percentile(ordered, 99):>9.2f}\n")
+    out.write("outcomes: " + ", ".join(f"{k} {v}" for k, v in sorted(errors.items())) + "\n")
+    if tokens:
+        out.write("tokens: " + ", ".join(f"{k} {v}" for k, v in sorted(tokens.items())) + "\n")
+    if speculation:
+        out.write("speculation: " + ", ".join(f"{k} {v}" for k, v in sorted(speculation.items())) + "\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise agent traces.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rep = sub.add_parser("report", help="Print p50/p95/p99 per stage from a JSONL trace file.")
+    rep.add_argument("path")
+    args = parser.parse_args(argv)
+
+    with open(args.path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        print("No traces found.")
+        return
+    report(records)
+
+if __name__ == "__main__":
+    main()